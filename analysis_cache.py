@@ -0,0 +1,72 @@
+# Local columnar cache of the voting data used by the plot scripts.
+#
+# Cache is a directory with meta.json (dbname, ballots_config and number of
+# registration blocks) and one .npy file per column named <table>.<column>.npy,
+# every column is memory-mapped on load.
+# Tables and columns:
+#   votes         - hash (S32), ts (int64 epoch ms), author (S32), choice (int64, -1 if not decrypted)
+#   issues        - voter (int32 index in registrations, -1 if unknown), ts (int64 epoch ms)
+#   auths         - voter_key (S32), ts (int64 epoch ms)
+#   registrations - block (int32 index of registration block of each registered voter)
+
+import os
+import json
+import numpy as np
+
+KEY_BYTES = 32
+NO_CHOICE = -1
+
+TABLES = {
+    "votes":         ["hash", "ts", "author", "choice"],
+    "issues":        ["voter", "ts"],
+    "auths":         ["voter_key", "ts"],
+    "registrations": ["block"],
+}
+
+def HexColumn(values):
+    # Hex strings of fixed width to a compact array of raw bytes, missing values are zeroed
+    raw = bytes.fromhex("".join(v if v is not None else "00" * KEY_BYTES for v in values))
+    return np.frombuffer(raw, dtype=f"S{KEY_BYTES}")
+
+def EncodeVoters(registered_voters, issue_voters):
+    # Voters are numbered in order of registration, issued ballots refer to these numbers
+    voter_codes = {v: i for i,v in enumerate(registered_voters)}
+    return np.array([voter_codes.get(v, -1) for v in issue_voters], dtype=np.int32)
+
+# Sort-merge lookup: index of every query in keys, -1 if absent. For duplicate keys it is the one
+# with the largest value of by (e.g. the last vote by time), without by - the last one in array order.
+def KeyIndex(keys, queries, by = None):
+    keys = np.asarray(keys)
+    queries = np.asarray(queries)
+    if len(keys) == 0:
+        return np.full(len(queries), -1)
+    if by is None:
+        order = np.argsort(keys, kind="stable")
+    else:
+        # Stable sort by key of rows sorted by value keeps rows of every key ordered by value
+        by_order = np.argsort(by, kind="stable")
+        order = by_order[np.argsort(keys[by_order], kind="stable")]
+    sorted_keys = keys[order]
+    pos = np.searchsorted(sorted_keys, queries, side="right") - 1
+    found = (pos >= 0) & (sorted_keys[np.maximum(pos, 0)] == queries)
+    return np.where(found, order[np.maximum(pos, 0)], -1)
+
+def ColumnPath(cache_dir, table, column):
+    return os.path.join(cache_dir, f"{table}.{column}.npy")
+
+def SaveTable(cache_dir, table, columns):
+    os.makedirs(cache_dir, exist_ok=True)
+    for column in TABLES[table]:
+        np.save(ColumnPath(cache_dir, table, column), columns[column])
+
+def LoadTable(cache_dir, table):
+    return {column: np.load(ColumnPath(cache_dir, table, column), mmap_mode="r") for column in TABLES[table]}
+
+def SaveMeta(cache_dir, meta):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+def LoadMeta(cache_dir):
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        return json.load(f)
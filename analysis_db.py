@@ -0,0 +1,123 @@
+# Compact analysis tables in the vote database, see build_analysis_db.py.
+#
+# Tables of schema "analysis" keep only the fields used by the plot scripts,
+# keys and hashes as bytea, times as bigint epoch milliseconds:
+#   votes         - hash, ts, author, choice (-1 if not decrypted)
+#   blocks        - hash, block (index of registration block in order of time), ts
+#   registrations - voter_idx (voters numbered in order of registration), block, voter
+#   issues        - hash, voter (voter_idx, -1 if unknown), ts
+#   auths         - hash, voter_key, ts
+# Refresh is incremental: only transactions not older than the last loaded one
+# are read, choices are updated only for not yet decrypted votes. Registration
+# blocks are numbered in order of time and hash, all scripts use this order.
+
+import timebins
+
+SCHEMA_SQL = """
+CREATE SCHEMA IF NOT EXISTS analysis;
+CREATE TABLE IF NOT EXISTS analysis.votes (hash bytea PRIMARY KEY, ts bigint NOT NULL, author bytea NOT NULL, choice bigint NOT NULL);
+CREATE INDEX IF NOT EXISTS votes_choice_ts_idx ON analysis.votes (choice, ts);
+CREATE INDEX IF NOT EXISTS votes_undecrypted_idx ON analysis.votes (hash) WHERE choice = -1;
+CREATE INDEX IF NOT EXISTS votes_author_idx ON analysis.votes (author);
+CREATE TABLE IF NOT EXISTS analysis.blocks (hash bytea PRIMARY KEY, block integer NOT NULL UNIQUE, ts bigint NOT NULL);
+CREATE TABLE IF NOT EXISTS analysis.registrations (voter_idx integer PRIMARY KEY, block integer NOT NULL, voter text NOT NULL);
+CREATE INDEX IF NOT EXISTS registrations_voter_idx ON analysis.registrations (voter);
+CREATE INDEX IF NOT EXISTS registrations_block_idx ON analysis.registrations (block);
+CREATE TABLE IF NOT EXISTS analysis.issues (hash bytea PRIMARY KEY, voter integer NOT NULL, ts bigint NOT NULL);
+CREATE INDEX IF NOT EXISTS issues_unknown_voter_idx ON analysis.issues (hash) WHERE voter = -1;
+CREATE INDEX IF NOT EXISTS issues_voter_idx ON analysis.issues (voter);
+CREATE TABLE IF NOT EXISTS analysis.auths (hash bytea PRIMARY KEY, voter_key bytea NOT NULL, ts bigint NOT NULL);
+CREATE INDEX IF NOT EXISTS auths_voter_key_idx ON analysis.auths (voter_key);
+CREATE TABLE IF NOT EXISTS analysis.refresh_log (refreshed timestamp with time zone NOT NULL DEFAULT now());
+"""
+
+ZERO_KEY = "repeat('0', 64)"
+
+# Transactions of the method not older than the newest row of the analysis table
+def NewTransactions(method_id, table):
+    return f"""t.method_id = {method_id}
+               and t.datetime >= to_timestamp(coalesce((select max(ts) from analysis.{table}), 0) / 1000.0)"""
+
+# Last registration of every voter, duplicates in registration blocks are resolved like in analysis_cache
+LAST_REGISTRATION = "(select voter, max(voter_idx) as voter_idx from analysis.registrations group by voter)"
+
+# Refresh steps, in order of dependencies
+REFRESH_STEPS = [
+    ("votes", f"""insert into analysis.votes
+                  select decode(t.hash, 'hex'), {timebins.SqlEpochMs("t.datetime")}, decode(coalesce(t.author, {ZERO_KEY}), 'hex'),
+                         coalesce(d.decrypted_choice[1], -1)
+                  from transactions t left join decrypted_ballots d on d.store_tx_hash = t.hash
+                  where {NewTransactions(6, "votes")}
+                  on conflict (hash) do nothing"""),
+    ("choices", """update analysis.votes v set choice = coalesce(d.decrypted_choice[1], -1)
+                   from decrypted_ballots d
+                   where v.choice = -1 and d.store_tx_hash = encode(v.hash, 'hex')"""),
+    ("blocks", f"""insert into analysis.blocks
+                   select decode(t.hash, 'hex'),
+                          coalesce((select max(block) from analysis.blocks), -1) + row_number() over (order by t.datetime, t.hash),
+                          {timebins.SqlEpochMs("t.datetime")}
+                   from transactions t
+                   where {NewTransactions(1, "blocks")}
+                     and not exists (select 1 from analysis.blocks b where b.hash = decode(t.hash, 'hex'))"""),
+    ("registrations", """insert into analysis.registrations
+                         select coalesce((select max(voter_idx) from analysis.registrations), -1) + row_number() over (order by b.block, v.n),
+                                b.block, v.voter
+                         from analysis.blocks b join transactions t on t.hash = encode(b.hash, 'hex'),
+                              jsonb_array_elements_text(t.payload->'voters') with ordinality v(voter, n)
+                         where b.block > coalesce((select max(block) from analysis.registrations), -1)"""),
+    ("issues", f"""insert into analysis.issues
+                   select decode(t.hash, 'hex'), coalesce(r.voter_idx, -1), {timebins.SqlEpochMs("t.datetime")}
+                   from transactions t left join {LAST_REGISTRATION} r on r.voter = t.payload->>'voter_id'
+                   where {NewTransactions(4, "issues")}
+                   on conflict (hash) do nothing"""),
+    ("unknown_voters", f"""update analysis.issues i set voter = r.voter_idx
+                           from transactions t, {LAST_REGISTRATION} r
+                           where i.voter = -1 and t.hash = encode(i.hash, 'hex') and r.voter = t.payload->>'voter_id'"""),
+    ("auths", f"""insert into analysis.auths
+                  select decode(t.hash, 'hex'), decode(coalesce(t.payload->>'voter_key', {ZERO_KEY}), 'hex'), {timebins.SqlEpochMs("t.datetime")}
+                  from transactions t
+                  where {NewTransactions(5, "auths")}
+                  on conflict (hash) do nothing"""),
+]
+
+def Exists(cur):
+    cur.execute("select to_regclass('analysis.refresh_log') is not null")
+    return cur.fetchone()[0]
+
+def Create(cur):
+    cur.execute(SCHEMA_SQL)
+
+def Drop(cur):
+    cur.execute("DROP SCHEMA IF EXISTS analysis CASCADE")
+
+def LastRefresh(cur):
+    cur.execute("select max(refreshed) from analysis.refresh_log")
+    return cur.fetchone()[0]
+
+# Compact tables are used by the plot scripts if present, their freshness is reported
+def Use(cur):
+    if not Exists(cur):
+        return False
+    print("Используются таблицы анализа, обновлённые", LastRefresh(cur))
+    return True
+
+# Runs all refresh steps in one transaction, returns number of changed rows of every step
+def Refresh(conn):
+    cur = conn.cursor()
+    changed = {}
+    for name, sql in REFRESH_STEPS:
+        cur.execute(sql)
+        changed[name] = cur.rowcount
+    cur.execute("insert into analysis.refresh_log default values")
+    conn.commit()
+    for table in ("votes", "blocks", "registrations", "issues", "auths"):
+        cur.execute(f"analyze analysis.{table}")
+    conn.commit()
+    return changed
+
+# Cheap refresh of choices only, for use right after decryption
+def RefreshChoices(conn):
+    cur = conn.cursor()
+    cur.execute(dict(REFRESH_STEPS)["choices"])
+    conn.commit()
+    return cur.rowcount
@@ -0,0 +1,70 @@
+# Latency between key check and vote by option of the vote (authtime_plot.py, dashboard.py).
+#
+# Every key check joined with the last vote by time of the same voter key is counted once
+# in a dense matrix options x latency milliseconds with a single 2D bincount.
+# Rows are options in ascending order, undecrypted votes are in the NO_CHOICE row.
+# Histograms of any grouping of options (parties, candidate lists, districts) are
+# sums of rows of the matrix rebinned to the needed width, so groupings are
+# changed without another join. The matrix is saved to .npz together with the
+# district of every option, identity of its data (database or cache) and the
+# percent of sampled voters (nan if all), so it is reused only for the same data.
+#
+# Grouping is a JSON file with a list of groups, each selects options by
+# "candidates" (list of IDs), "config" (JSON file of time_plot.py, its
+# candidates_to_plot), "district" (district ID) or "rest" (all other decrypted):
+#   {"groups": [{"name": "ЕР", "candidates": [151256486]}, {"name": "Остальные", "rest": true}]}
+
+import json
+import numpy as np
+import analysis_cache
+import timebins
+
+LATENCY_MS          = 5000
+
+# Matrix of counts options x LATENCY_MS from vote minus key check times and choices of votes
+def Build(timediffs, choices):
+    latency = timebins.LatencyToBin(timediffs, 1, LATENCY_MS)
+    options, option_idx = np.unique(np.asarray(choices), return_inverse=True)
+    matrix = np.bincount(option_idx * LATENCY_MS + latency, minlength=len(options) * LATENCY_MS)
+    return options, matrix.reshape(len(options), LATENCY_MS)
+
+# District of every option, 0 for unknown options and NO_CHOICE
+def OptionDistricts(options, ballots_config):
+    config_options = [int(o) for d in ballots_config for o in d["options"]]
+    # Last zero is taken by index -1 of options absent in config
+    config_districts = np.array([d["district_id"] for d in ballots_config for o in d["options"]] + [0])
+    return config_districts[timebins.SeriesIndex(options, config_options)]
+
+# Shape is explicit, so a matrix without options (no matched key checks) is rebinned too
+def Rebin(matrix, msecs_in_bin):
+    return matrix.reshape(matrix.shape[0], matrix.shape[1] // msecs_in_bin, msecs_in_bin).sum(axis=2)
+
+def Save(path, options, districts, matrix, source, sample = None):
+    np.savez(path, options=options, districts=districts, matrix=matrix, source=source, sample=np.nan if sample is None else sample)
+
+def Load(path):
+    with np.load(path) as f:
+        sample = float(f["sample"])
+        return f["options"], f["districts"], f["matrix"], str(f["source"]), None if np.isnan(sample) else sample
+
+# Names of groups and mask groups x options of a grouping
+def LoadGrouping(path, options, districts):
+    groups = json.load(open(path))["groups"]
+    masks = np.zeros((len(groups), len(options)), dtype=bool)
+    for i, g in enumerate(groups):
+        if "candidates" in g:
+            masks[i] = timebins.SeriesIndex(options, g["candidates"]) >= 0
+        elif "config" in g:
+            masks[i] = timebins.SeriesIndex(options, json.load(open(g["config"]))["candidates_to_plot"]) >= 0
+        elif "district" in g:
+            masks[i] = districts == g["district"]
+    rest = [i for i, g in enumerate(groups) if g.get("rest")]
+    masks[rest] = (options != analysis_cache.NO_CHOICE) & ~masks.any(axis=0)
+    return [g["name"] for g in groups], masks
+
+# Histograms of groups of options, groups x bins
+def GroupCounts(matrix, masks):
+    return masks.astype(matrix.dtype) @ matrix
+
+def Decrypted(options, matrix):
+    return matrix[options != analysis_cache.NO_CHOICE].sum(axis=0)
@@ -1,175 +1,202 @@
 #!/usr/bin/env python3
 
+import os
 import sys
-import psycopg2
-import psycopg2.extras
+import csv
 import json
-import time
-import pytz
 import itertools
 import argparse
-from datetime import datetime
+import numpy as np
+import analysis_cache
+import analysis_db
+import auth_latency
+import dbaccess
+import election_meta
+import timebins
+import profiling
+import confidence
+import sampling
 from matplotlib import pyplot as plt
 
 # Parse command line arguments
 parser = argparse.ArgumentParser()
-parser.add_argument("--dbaddr", help="Хост базы данных, по-умолчанию localhost", default="localhost")
-parser.add_argument("--dbname", help="Название базы данных, по-умолчанию v2021_om", default="v2021_om")
-parser.add_argument("--dbuser", help="Пользователь базы данных, по-умолчанию postgres", default="postgres")
-parser.add_argument("--dbpass", help="Пароль базы данных, по-умолчанию mypsqlpassword", default="mypsqlpassword")
+parser.add_argument("--cache", help="Каталог локального кэша данных (см. extract_cache.py), по-умолчанию используется БД", default=None)
+parser.add_argument("--bands", type=int, help="Построить 95%% доверительные интервалы долей групп по BANDS повторным выборкам (например 1000), по-умолчанию не строить", default=0)
+parser.add_argument("--csv", help="Сохранить гистограмму и доли групп (с доверительными интервалами) в CSV файл", default=None)
+parser.add_argument("--groups", nargs="+", help="JSON файлы группировок кандидатов, по графику долей на каждый, по-умолчанию party_groups.json", default=["party_groups.json"])
+parser.add_argument("--matrix", help="Файл матрицы задержек (.npz): если он рассчитан по тем же данным и выборке, то данные берутся из него без чтения голосов, если файла нет, то рассчитанная матрица сохраняется в него", default=None)
+dbaccess.AddArguments(parser)
+profiling.AddArguments(parser)
+sampling.AddArguments(parser)
 args = parser.parse_args()
+profiling.Start(args)
+if args.sample and args.cache:
+    print("Режим выборки работает только с базой данных")
+    sys.exit(1)
 
-# Connect to database
-conn = psycopg2.connect(
-    host=args.dbaddr,
-    user=args.dbuser,
-    password=args.dbpass,
-    database=args.dbname)
-
-cur = conn.cursor(cursor_factory = psycopg2.extras.DictCursor)
-cur2 = conn.cursor(cursor_factory = psycopg2.extras.DictCursor)
-
-# Some helper constants, all times are in seconds
-def TimeToSecs(t):
-    return int(time.mktime(t.timetuple()))
-def TimeToMSecs(t):
-    return TimeToSecs(t)*1000 + t.microsecond//1000
+# Some helper constants, all times are in milliseconds
 def MskT(d, h, m = 0, s = 0):
-    return datetime(2021, 9, d, h, m, s, tzinfo=MSK_TZ)
-    
-MSK_TZ              = pytz.timezone("Europe/Moscow")
-MSK_START_TIME      = datetime(2021, 9, 17, 8, 0, 0)
-UNIXTIME_MSK_START  = TimeToSecs(datetime(2021, 9, 17, 8, 0, 0, tzinfo=MSK_TZ))
-UNIXTIME_MSK_END    = TimeToSecs(datetime(2021, 9, 19, 21, 0, 0, tzinfo=MSK_TZ))
-BIN_TIME            = 60*60 
-RESULT_BINS         = (UNIXTIME_MSK_END-UNIXTIME_MSK_START) // BIN_TIME
-GRAPH_TICK_TIME     = 3600 * 1
+    return timebins.MskEpoch(d, h, m, s) * 1000
 
 MSECS_IN_BIN        = 20
-MSEC_BINS           = 5000 // MSECS_IN_BIN
-
-# Some helper functions
-def TimeDiffMs(t0, t1):
-    return (TimeToMSecs(t0) - TimeToMSecs(t1))
-    
-def DiffToBin(t0, t1):
-    diff_msec = TimeDiffMs(t0, t1) // MSECS_IN_BIN
-    if diff_msec < 0:
-        diff_msec = 0
-    elif diff_msec >= MSEC_BINS:
-        diff_msec = MSEC_BINS-1
-    return diff_msec 
-
-# Cache all voted keys in dict
-cur.execute("select author,datetime,hash from transactions where method_id=6")
-tmp_list = cur.fetchall()
-voter_keys_voted = [r[0] for r in tmp_list]
-vote_times_list = [r[1] for r in tmp_list]
-hash_list = [int(r[2], base=16) for r in tmp_list]
-vote_times = dict(zip(voter_keys_voted, tuple(zip(hash_list, vote_times_list))))
-assert(len(voter_keys_voted) == len(vote_times))
-
-# Cache all decrypted choices in dict
-cur.execute("select store_tx_hash,decrypted_choice[1] from decrypted_ballots")
-tmp_list = cur.fetchall()
-decrypted_choice_list = [int(r[1]) for r in tmp_list]
-hash_list = [int(r[0], base=16) for r in tmp_list]
-decrypted_choices = dict(zip(hash_list, decrypted_choice_list))
-
-# Some structs & consts (dirty)
-to_plot_bins = [0] * MSEC_BINS
-er_bins = [0] * MSEC_BINS
-kprf_bins = [0] * MSEC_BINS
-nl_bins = [0] * MSEC_BINS
-ldpr_bins = [0] * MSEC_BINS
-sr_bins = [0] * MSEC_BINS
-other_bins = [0] * MSEC_BINS
-total_bins = [0] * MSEC_BINS
-invalid_votes = 0
-
-sobyanin_list=[111906259, 182884641, 216438542, 162832179, 191070849, 142334949, 113246509, 178404279, 115873463, 182247230, 172154321, 217404809, 193509934, 111366669, 149646701]
-ug_list=[174344765, 153770437, 136749451, 147971856, 181315508, 191715167, 153469885, 173789580, 191550503, 191309977, 143715510, 213415260, 153878280, 164133981, 193846930]
-
-ER = 151256486
-KPRF = 113055488
-NL = 143916521
-ZEL = 122866705
-LDPR = 131810669
-SR = 167917702
-
-# Perform database searches for all access checks
-cur.execute("select payload->'voter_key',datetime from transactions where method_id=5")
-
-for i,row in enumerate(cur):
-    voter_key = row[0]
-    try:
-        vote_time = vote_times[voter_key][1]
-    except:
-        invalid_votes += 1
-        continue
-    
+MSEC_BINS           = auth_latency.LATENCY_MS // MSECS_IN_BIN
+MIN_BIN_TOTAL       = 100
+
+# Identity of the data, a saved matrix is used only for the same data and sample
+if args.cache:
+    source = "cache:" + os.path.abspath(args.cache)
+else:
+    conn = dbaccess.Connect(args)
+    source = election_meta.Identity(conn)
+
+# Saved matrix of latencies by option replaces reading of the data
+from_matrix = args.matrix is not None and os.path.exists(args.matrix)
+if from_matrix:
+    options, option_districts, matrix, matrix_source, matrix_sample = auth_latency.Load(args.matrix)
+    if (matrix_source, matrix_sample) != (source, args.sample):
+        print("Матрица задержек", args.matrix, "рассчитана по другим данным или выборке, удалите файл или укажите другой")
+        sys.exit(1)
+    print("Матрица задержек загружена из", args.matrix)
+elif args.cache:
+    ballots_config = analysis_cache.LoadMeta(args.cache)["ballots_config"]
+else:
+    ballots_config = election_meta.BallotsConfig(conn)
+    # Compact tables of build_analysis_db.py are used if present
+    use_analysis_db = analysis_db.Use(conn.cursor())
+if args.sample:
+    # Voters are sampled by key, so key checks and votes of sampled voters are joined exactly
+    print(sampling.Describe(args.sample))
+
+if not from_matrix:
+    # Load votes (voter key, time, decrypted choice) and voter key checks as compact arrays
+    with profiling.Stage("load") as stage:
+        if args.cache:
+            votes = analysis_cache.LoadTable(args.cache, "votes")
+            auths = analysis_cache.LoadTable(args.cache, "auths")
+            vote_author, vote_ts, vote_choice = votes["author"], votes["ts"], votes["choice"]
+            auth_key, auth_ts = auths["voter_key"], auths["ts"]
+        elif use_analysis_db:
+            vote_author, vote_ts, vote_choice = dbaccess.FetchArrays(conn, f"select author, ts, choice from analysis.votes where {sampling.Condition('author', dbaccess.BYTEA, args.sample)}",
+                                                                     [dbaccess.BYTEA, np.int64, np.int64])
+            auth_key, auth_ts = dbaccess.FetchArrays(conn, f"select voter_key, ts from analysis.auths where {sampling.Condition('voter_key', dbaccess.BYTEA, args.sample)}",
+                                                     [dbaccess.BYTEA, np.int64])
+        else:
+            sampled_votes = f"method_id=6 and {sampling.Condition('author', dbaccess.HEX, args.sample)}"
+            vote_author, vote_ts, vote_hash = dbaccess.FetchArrays(conn, f"select author,{timebins.SqlEpochMs()},hash from transactions where {sampled_votes}",
+                                                                   [dbaccess.HEX, np.int64, dbaccess.HEX])
+            decrypted_hash, decrypted_choice = dbaccess.FetchArrays(conn, "select store_tx_hash,decrypted_choice[1] from decrypted_ballots" +
+                                                                    (f" where store_tx_hash in (select hash from transactions where {sampled_votes})" if args.sample else ""),
+                                                                    [dbaccess.HEX, np.int64])
+            # Masked assignment, decrypted_ballots is empty until decrypt_ballots.py is run
+            decrypted_idx = analysis_cache.KeyIndex(decrypted_hash, vote_hash)
+            vote_choice = np.full(len(vote_hash), analysis_cache.NO_CHOICE, dtype=np.int64)
+            found = decrypted_idx >= 0
+            vote_choice[found] = decrypted_choice[decrypted_idx[found]]
+            del vote_hash, decrypted_hash, decrypted_choice, decrypted_idx, found
+            auth_key, auth_ts = dbaccess.FetchArrays(conn, f"""select payload->>'voter_key',{timebins.SqlEpochMs()} from transactions
+                                                         where method_id=5 and {sampling.Condition("payload->'voter_key'", sampling.JSON, args.sample)}""",
+                                                     [dbaccess.HEX, np.int64])
+        stage["rows"] = len(vote_ts) + len(auth_ts)
+
+    # Sort-merge join of every key check with the last vote of the same voter key, by time of the vote
+    # as rows of the queries are not ordered
+    with profiling.Stage("join") as stage:
+        vote_idx = analysis_cache.KeyIndex(vote_author, auth_key, vote_ts)
+        matched = vote_idx >= 0
+        vote_idx = vote_idx[matched]
+
+        timediffs = vote_ts[vote_idx] - auth_ts[matched]
+        cands = vote_choice[vote_idx]
+        stage["rows"] = len(vote_author) + len(auth_key)
+
     # Filter by time if desired
-    # ~ if not (((vote_time > MskT(19,2)) and (vote_time < MskT(19,12))) or \
-        # ~ ((vote_time > MskT(19,13)) and (vote_time < MskT(19,16)))):
-        # ~ continue
-    
-    timediff = TimeDiffMs(vote_time, row[1])
-    timediff_bin = DiffToBin(vote_time, row[1])
-    to_plot_bins[timediff_bin] += 1
-    
-    total_bins[timediff_bin]+=1
-    chash = vote_times[voter_key][0]
-    cand = decrypted_choices[chash]
-    
-    if cand == ER:
-        er_bins[timediff_bin]+=1
-    elif cand == KPRF:
-        kprf_bins[timediff_bin]+=1
-    elif cand == NL:
-        nl_bins[timediff_bin]+=1
-    elif cand == LDPR:
-        ldpr_bins[timediff_bin]+=1
-    elif cand == SR:
-        sr_bins[timediff_bin]+=1
-    else:
-        other_bins[timediff_bin]+=1
-
-# Normalize
-for i in range(1,MSEC_BINS):
-    if (total_bins[i] >= 100):
-        er_bins[i] /= total_bins[i] * 0.01
-        kprf_bins[i] /= total_bins[i] * 0.01
-        nl_bins[i] /= total_bins[i] * 0.01
-        ldpr_bins[i] /= total_bins[i] * 0.01
-        sr_bins[i] /= total_bins[i] * 0.01
-        other_bins[i] /= total_bins[i] * 0.01
-    else:
-        er_bins[i] = er_bins[i-1]
-        kprf_bins[i] = kprf_bins[i-1]
-        nl_bins[i] = nl_bins[i-1]
-        ldpr_bins[i] = ldpr_bins[i-1]
-        sr_bins[i] = sr_bins[i-1]
-        other_bins[i] = other_bins[i-1]
-
-# Plotting
-fig,axs = plt.subplots(2)
-axs[0].plot(to_plot_bins)
-axs[0].grid()
-axs[1].plot(er_bins)
-axs[1].plot(kprf_bins)
-axs[1].plot(nl_bins)
-axs[1].plot(ldpr_bins)
-axs[1].plot(sr_bins)
-axs[1].plot(other_bins)
-axs[1].grid()
-axs[1].legend(["ЕР, %", "КПРФ, %", "Новые Люди, %", "ЛДПР, %", "СР, %", "Остальные, %"])
-
-ticks = range(0, MSEC_BINS, MSECS_IN_BIN)
-axs[0].set_xticks(ticks)
-axs[0].set_xticklabels([r*MSECS_IN_BIN for r in ticks])
-axs[1].set_xticks(ticks)
-axs[1].set_xticklabels([r*MSECS_IN_BIN for r in ticks])
-axs[1].set_xlabel("Время между транзакцией проверки ключа избирателя и транзакцией голосования в миллисекундах")
+    # ~ t = vote_ts[vote_idx]
+    # ~ keep = ((t > MskT(19,2)) & (t < MskT(19,12))) | ((t > MskT(19,13)) & (t < MskT(19,16)))
+    # ~ timediffs, cands = timediffs[keep], cands[keep]
+
+    decrypted = cands != analysis_cache.NO_CHOICE
+
+    # Report unmatched records by category
+    print("Проверок ключа без голоса:", sampling.Estimate(int(np.count_nonzero(~matched)), args.sample))
+    print("Голосов без проверки ключа:", sampling.Estimate(int(np.count_nonzero(analysis_cache.KeyIndex(auth_key, vote_author) < 0)), args.sample))
+    print("Повторных голосов с тем же ключом:", sampling.Estimate(len(vote_author) - len(np.unique(vote_author)), args.sample))
+    print("Нерасшифрованных голосов после проверки ключа:", sampling.Estimate(int(np.count_nonzero(~decrypted)), args.sample))
+
+    # Dense matrix of key checks by option and latency, all groupings are sums of its rows
+    with profiling.Stage("matrix") as stage:
+        options, matrix = auth_latency.Build(timediffs, cands)
+        option_districts = auth_latency.OptionDistricts(options, ballots_config)
+        stage["rows"] = len(timediffs)
+    if args.matrix:
+        auth_latency.Save(args.matrix, options, option_districts, matrix, source, args.sample)
+        print("Матрица задержек сохранена в", args.matrix)
+
+# Latency histograms, in total and for groups of options of every grouping
+with profiling.Stage("histograms") as stage:
+    binned = auth_latency.Rebin(matrix, MSECS_IN_BIN)
+    to_plot_bins = binned.sum(axis=0)
+    total_bins = auth_latency.Decrypted(options, binned)
+    groupings = []
+    for path in args.groups:
+        names, masks = auth_latency.LoadGrouping(path, options, option_districts)
+        groupings.append((names, auth_latency.GroupCounts(binned, masks)))
+    stage["rows"] = binned.size
+
+# Shares of groups in every latency bin. Without confidence bands bins with few votes
+# repeat the previous share, with bands all bins are shown and the bands tell noise from signal.
+def Shares(group_bins):
+    shares = np.divide(group_bins * 100.0, total_bins, out=np.zeros(group_bins.shape), where=total_bins != 0)
+    if args.bands or args.sample:
+        return shares, confidence.ShareBands(group_bins, total_bins, args.bands or confidence.RESAMPLES)
+    shown = np.maximum.accumulate(np.where(total_bins >= MIN_BIN_TOTAL, np.arange(MSEC_BINS), 0))
+    return shares[:, shown], None
+
+with profiling.Stage("shares") as stage:
+    groupings = [(names, *Shares(group_bins)) for names, group_bins in groupings]
+    stage["rows"] = sum(len(names) for names, _, _ in groupings) * MSEC_BINS
+
+# Histogram of a sample is scaled to all data and shown with its sampling error
+if args.sample:
+    to_plot_bins, to_plot_error = sampling.ScaleCounts(to_plot_bins, args.sample)
+
+if args.csv:
+    with open(args.csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        header = ["Задержка, мс", "Проверок ключа", "Расшифровано"]
+        for names, shares, bands in groupings:
+            header += [n + ", %" for n in names]
+            if bands is not None:
+                header += [n + suffix for suffix in (", % (нижняя граница)", ", % (верхняя граница)") for n in names]
+        writer.writerow(header)
+        for i in range(MSEC_BINS):
+            row = [i * MSECS_IN_BIN, f"{to_plot_bins[i]:g}", total_bins[i]]
+            for names, shares, bands in groupings:
+                row += [f"{v:g}" for v in shares[:, i]]
+                if bands is not None:
+                    row += [f"{v:g}" for v in np.concatenate([bands[0][:, i], bands[1][:, i]])]
+            writer.writerow(row)
+    print("Гистограмма сохранена в", args.csv)
+
+# Plotting, histogram and a plot of shares for every grouping
+with profiling.Stage("draw"):
+    fig,axs = plt.subplots(1 + len(groupings), sharex=True)
+    if args.sample:
+        axs[0].fill_between(range(MSEC_BINS), to_plot_bins - 2 * to_plot_error, to_plot_bins + 2 * to_plot_error, alpha=0.2, linewidth=0)
+    axs[0].plot(to_plot_bins)
+    axs[0].grid()
+    for ax, (names, shares, bands) in zip(axs[1:], groupings):
+        lines = []
+        for i,share in enumerate(shares):
+            lines += ax.plot(share)
+            if bands is not None:
+                ax.fill_between(range(MSEC_BINS), bands[0][i], bands[1][i], color=lines[-1].get_color(), alpha=0.2, linewidth=0)
+        ax.grid()
+        ax.legend(lines, [n + ", %" for n in names])
+
+    ticks = range(0, MSEC_BINS, MSECS_IN_BIN)
+    axs[-1].set_xticks(ticks)
+    axs[-1].set_xticklabels([r*MSECS_IN_BIN for r in ticks])
+    axs[-1].set_xlabel("Время между транзакцией проверки ключа избирателя и транзакцией голосования в миллисекундах")
 
 # Show window with plot    
 plt.show()
@@ -0,0 +1,21 @@
+# Ballot decryption shared by decrypt_ballots.py and live plotting.
+# Based on https://gist.github.com/SaveTheRbtz/246eab8557b0217ab3945e15cef6ffe8
+
+from nacl.public import PrivateKey, PublicKey, Box
+from choices_pb2 import Choices
+
+# SQL columns of encrypted choice of a vote transaction t
+ENCRYPTED_CHOICE_COLUMNS = """t.payload->'encrypted_choice'->>'public_key',
+                              t.payload->'encrypted_choice'->>'encrypted_message',
+                              t.payload->'encrypted_choice'->>'nonce'"""
+
+# Private key is published in the payload of method_id=8 transaction
+def LoadPrivateKey(cur):
+    cur.execute("select payload->>'private_key' from transactions where method_id=8")
+    return cur.fetchone()[0]
+
+def DecryptBallot(skey, public_key, encrypted_message, nonce):
+    box = Box(skey, PublicKey(bytes.fromhex(public_key)))
+    pb = box.decrypt(bytes.fromhex(encrypted_message), bytes.fromhex(nonce))
+    offset = int.from_bytes(pb[:2], 'big')+2
+    return Choices().FromString(pb[offset:]).data[0]
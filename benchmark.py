@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+import dbargs
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Замер времени работы скриптов на синтетических базах данных разного масштаба (см. synth_db.py)")
+parser.add_argument("--scales", type=float, nargs="+", help="Масштабы синтетических баз, по-умолчанию 0.1 1 10", default=[0.1, 1, 10])
+parser.add_argument("--seed", type=int, help="Начальное значение генератора случайных чисел, по-умолчанию 1", default=1)
+parser.add_argument("-o", action="store", help="JSON файл для сохранения результатов, по-умолчанию benchmark.json", default="benchmark.json")
+parser.add_argument("--keep", action="store_true", help="Не удалять синтетические базы данных после замеров")
+# Databases are created by the benchmark itself
+dbargs.AddArguments(parser, dbname=None)
+args = parser.parse_args()
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stages in order of execution, decryption goes first so the plots see the complete data
+STAGES = [
+    ("decrypt",        ["decrypt_ballots.py"]),
+    ("time_plot",      ["time_plot.py", "-c", "{config}"]),
+    ("turnout_plot",   ["turnout_plot.py"]),
+    ("authtime_plot",  ["authtime_plot.py"]),
+    ("extract_cache",  ["extract_cache.py", "-o", "{cache}"]),
+    ("time_plot_c",    ["time_plot.py", "-c", "{config}", "--cache", "{cache}"]),
+    ("turnout_plot_c", ["turnout_plot.py", "--cache", "{cache}"]),
+    ("authtime_plot_c",["authtime_plot.py", "--cache", "{cache}"]),
+]
+
+# Scripts with per-stage profiling (see profiling.py), their stage reports are saved too
+PROFILED_STAGES = {"decrypt", "time_plot", "turnout_plot", "authtime_plot", "time_plot_c", "turnout_plot_c", "authtime_plot_c"}
+
+def DbArgs(dbname):
+    return ["--dbaddr", args.dbaddr, "--dbname", dbname, "--dbuser", args.dbuser, "--dbpass", args.dbpass]
+
+def RecreateDb(dbname, drop_only = False):
+    conn = dbargs.Connect(args, "postgres")
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"DROP DATABASE IF EXISTS {dbname}")
+    if not drop_only:
+        cur.execute(f"CREATE DATABASE {dbname}")
+    conn.close()
+
+# Runs one script with plots rendered off screen, returns wall time in seconds
+def RunStage(name, command, profile = None):
+    env = dict(os.environ, MPLBACKEND="Agg")
+    if profile:
+        command = command + ["--profile", profile]
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + command, cwd=SCRIPT_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(f"Ошибка на этапе {name}:")
+        print(result.stdout.decode("utf-8", "replace")[-2000:])
+        sys.exit(1)
+    return elapsed
+
+# Plot config with all candidates of the first synthetic district
+def WritePlotConfig(dbname, path):
+    conn = dbargs.Connect(args, dbname)
+    cur = conn.cursor()
+    cur.execute("select payload from transactions where method_id=0")
+    options = cur.fetchone()[0]["ballots_config"][0]["options"]
+    conn.close()
+    with open(path, "w") as f:
+        json.dump({"minutes_in_bin": 30, "minutes_per_axis_tick": 120, "candidates_to_plot": [int(o) for o in options],
+                   "percentage": True, "integrate": False}, f)
+
+results = []
+with tempfile.TemporaryDirectory() as tmp:
+    for scale in args.scales:
+        dbname = "bench_" + str(scale).replace(".", "_")
+        print("Масштаб", scale, "база данных", dbname)
+        RecreateDb(dbname)
+        times = {"synth_db": RunStage("synth_db", ["synth_db.py", "--scale", str(scale), "--seed", str(args.seed)] + DbArgs(dbname))}
+        conn = dbargs.Connect(args, dbname)
+        cur = conn.cursor()
+        cur.execute("select count(*) from transactions where method_id=6")
+        votes = cur.fetchone()[0]
+        conn.close()
+        config = os.path.join(tmp, "plot_config.json")
+        WritePlotConfig(dbname, config)
+        profiles = {}
+        for name, command in STAGES:
+            command = [c.format(config=config, cache=os.path.join(tmp, dbname)) for c in command]
+            profile = os.path.join(tmp, name + ".json") if name in PROFILED_STAGES else None
+            times[name] = RunStage(name, command + DbArgs(dbname), profile)
+            if profile:
+                with open(profile) as f:
+                    profiles[name] = json.load(f)["stages"]
+            print(f"  {name:16} {times[name]:8.2f} с")
+        results.append({"scale": scale, "votes": votes, "seconds": times, "profiles": profiles})
+        if not args.keep:
+            RecreateDb(dbname, drop_only=True)
+
+with open(args.o, "w") as f:
+    json.dump(results, f, indent=2)
+
+# Summary table, seconds per stage for every scale
+print(f"{'этап':16}" + "".join(f"{r['scale']:>10}" for r in results))
+print(f"{'голосов':16}" + "".join(f"{r['votes']:>10}" for r in results))
+for name in results[0]["seconds"] if results else []:
+    print(f"{name:16}" + "".join(f"{r['seconds'][name]:10.2f}" for r in results))
+print("Результаты сохранены в", args.o)
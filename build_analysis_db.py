@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+import argparse
+import analysis_db
+import dbaccess
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Создание и инкрементальное обновление компактных таблиц для анализа (схема analysis)")
+parser.add_argument("--rebuild", action="store_true", help="Удалить таблицы анализа и построить их заново")
+dbaccess.AddArguments(parser)
+args = parser.parse_args()
+
+conn = dbaccess.Connect(args)
+cur = conn.cursor()
+if args.rebuild:
+    analysis_db.Drop(cur)
+analysis_db.Create(cur)
+conn.commit()
+
+print("Обновление таблиц анализа, при первом запуске это может занять продолжительное время...")
+changed = analysis_db.Refresh(conn)
+print("Новых голосов:", changed["votes"], "дорасшифрованных ранее загруженных голосов:", changed["choices"])
+print("Новых блоков регистрации:", changed["blocks"], "избирателей:", changed["registrations"])
+print("Новых выданных бюллетеней:", changed["issues"], "найдено избирателей для ранее выданных:", changed["unknown_voters"])
+print("Новых проверок ключей:", changed["auths"])
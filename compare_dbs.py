@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import argparse
+import concurrent.futures
+import matplotlib
+import numpy as np
+import analysis_cache
+import analysis_db
+import dbaccess
+import timebins
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Сравнение нескольких голосований (баз данных) на общих графиках, базы обрабатываются параллельно")
+parser.add_argument("databases", nargs="+", help="Названия баз данных, например v2021_om v2021_party")
+parser.add_argument("--minutes-in-bin", type=int, help="Число минут на точку графиков по времени, по-умолчанию 30", default=30)
+parser.add_argument("--absolute", action="store_true", help="Абсолютные числа вместо процентов от полного числа в каждой базе")
+parser.add_argument("-o", action="store", help="Сохранить графики в файл PNG и кривые в CSV с этим префиксом вместо вывода на экран", default=None)
+dbaccess.AddArguments(parser, dbname=None)
+args = parser.parse_args()
+
+# Saving to files does not need a window
+if args.o:
+    matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+
+# Some helper constants
+BIN_TIME            = args.minutes_in_bin * 60
+GRAPH_TICK_TIME     = 3600 * 4
+MSECS_IN_BIN        = 20
+MSEC_BINS           = 5000 // MSECS_IN_BIN
+
+# Queries of every analysis, for compact analysis tables and for raw transactions
+QUERIES = {
+    "votes":  ("select ts, author, choice from analysis.votes",
+               f"""select {timebins.SqlEpochMs("t.datetime")}, t.author, coalesce(d.decrypted_choice[1], {analysis_cache.NO_CHOICE})
+                   from transactions t left join decrypted_ballots d on d.store_tx_hash = t.hash where t.method_id=6"""),
+    "issues": ("select ts from analysis.issues",
+               f"select {timebins.SqlEpochMs()} from transactions where method_id=4"),
+    "auths":  ("select ts, voter_key from analysis.auths",
+               f"select {timebins.SqlEpochMs()}, payload->>'voter_key' from transactions where method_id=5"),
+}
+
+# Loads and bins all data of one database, runs in its own thread with its own connection.
+# Threads mostly wait for the server or run numpy code, both release the GIL.
+def AnalyzeDb(dbname):
+    start = time.perf_counter()
+    conn = dbaccess.Connect(args, dbname)
+    use_analysis_db = analysis_db.Exists(conn.cursor())
+    key = dbaccess.BYTEA if use_analysis_db else dbaccess.HEX
+    source = 0 if use_analysis_db else 1
+    vote_ts, vote_author, vote_choice = dbaccess.FetchArrays(conn, QUERIES["votes"][source], [np.int64, key, np.int64])
+    issue_ts, = dbaccess.FetchArrays(conn, QUERIES["issues"][source], [np.int64])
+    auth_ts, auth_key = dbaccess.FetchArrays(conn, QUERIES["auths"][source], [np.int64, key])
+    conn.close()
+
+    # Latency between key check and the last vote by time with the same key
+    vote_idx = analysis_cache.KeyIndex(vote_author, auth_key, vote_ts)
+    matched = vote_idx >= 0
+    latency = vote_ts[vote_idx[matched]] - auth_ts[matched]
+    return {
+        "vote_bins": timebins.BinCounts(vote_ts, BIN_TIME),
+        "issue_bins": timebins.BinCounts(issue_ts, BIN_TIME),
+        "latency_bins": np.bincount(timebins.LatencyToBin(latency, MSECS_IN_BIN, MSEC_BINS), minlength=MSEC_BINS),
+        "summary": {
+            "Голосов": len(vote_ts),
+            "Расшифровано": int(np.count_nonzero(vote_choice != analysis_cache.NO_CHOICE)),
+            "Выдано бюллетеней": len(issue_ts),
+            "Проверок ключей": len(auth_ts),
+            "Проверок без голоса": int(np.count_nonzero(~matched)),
+            "Время загрузки, с": round(time.perf_counter() - start, 1),
+        },
+    }
+
+def Scale(binned):
+    return binned if args.absolute else timebins.Normalize(binned)
+
+# Every database gets its own thread, total time is close to the slowest database
+start = time.perf_counter()
+with concurrent.futures.ThreadPoolExecutor(max_workers=len(args.databases)) as pool:
+    futures = {db: pool.submit(AnalyzeDb, db) for db in args.databases}
+    results = {}
+    for db, f in futures.items():
+        try:
+            results[db] = f.result()
+        except Exception as e:
+            print("Ошибка обработки базы данных", db, ":", e)
+            sys.exit(1)
+print("Общее время загрузки: {:.1f} с".format(time.perf_counter() - start))
+
+# Side-by-side summary table
+width = max(len(db) for db in args.databases) + 2
+print(f"{'':22}" + "".join(f"{db:>{width}}" for db in args.databases))
+for name in results[args.databases[0]]["summary"]:
+    print(f"{name:22}" + "".join(f"{results[db]['summary'][name]:>{width}}" for db in args.databases))
+
+# All databases on the same time and latency axes
+unit = "" if args.absolute else ", %"
+fig, axs = plt.subplots(3, figsize=(16, 12))
+for db in args.databases:
+    axs[0].plot(Scale(results[db]["vote_bins"]))
+    axs[1].plot(Scale(results[db]["issue_bins"]))
+    axs[2].plot(Scale(results[db]["latency_bins"]))
+ticks = timebins.GenerateTicks(BIN_TIME, GRAPH_TICK_TIME)
+for ax, title in zip(axs[:2], ["Голоса" + unit, "Выданные бюллетени" + unit]):
+    ax.set_xticks(ticks[0])
+    ax.set_xticklabels(ticks[1], rotation=90)
+    ax.set_title(title)
+latency_ticks = range(0, MSEC_BINS, MSECS_IN_BIN)
+axs[2].set_xticks(latency_ticks)
+axs[2].set_xticklabels([r*MSECS_IN_BIN for r in latency_ticks])
+axs[2].set_title("Время между транзакцией проверки ключа избирателя и транзакцией голосования в миллисекундах" + unit)
+for ax in axs:
+    ax.grid()
+    ax.legend(args.databases)
+plt.tight_layout()
+
+if args.o:
+    plt.savefig(args.o + ".png")
+    # Time curves of all databases in one table with a common time column
+    columns = [Scale(results[db][s]) for db in args.databases for s in ("vote_bins", "issue_bins")]
+    with open(args.o + ".csv", "w") as f:
+        f.write(",".join(["time"] + [f"{db}_{s}" for db in args.databases for s in ("votes", "issues")]) + "\n")
+        for b in range(timebins.ResultBins(BIN_TIME)):
+            values = [f"{c[b]:g}" for c in columns]
+            f.write(",".join([timebins.BinToTime(b * BIN_TIME).strftime("%d.%m %H:%M")] + values) + "\n")
+    print("Графики и кривые сохранены в", args.o + ".png", args.o + ".csv")
+else:
+    plt.show()
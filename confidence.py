@@ -0,0 +1,43 @@
+# Confidence bands of share curves by Bayesian bootstrap.
+#
+# Share of a series in a bin is count / total, where total is the number of
+# votes (or key checks) of the bin. Bayesian bootstrap of the votes of a bin
+# draws shares of all series from a Dirichlet distribution, its marginal for
+# one series is Beta(count + 1/2, total - count + 1/2) with Jeffreys prior,
+# so every series and bin is resampled independently and all at once. Unlike
+# plain resampling, bins where a series has 0% or 100% still get a band.
+# Bins are split into chunks of bounded size which are processed in a pool,
+# empty bins get zero bands.
+
+import os
+import multiprocessing
+import numpy as np
+
+RESAMPLES           = 1000
+LEVEL               = 95
+CHUNK_VALUES        = 1 << 21
+SEED                = 2021
+
+# Percentiles of resampled shares of a chunk of bins, in percent
+def BandsChunk(chunk):
+    counts, totals, resamples, level, seed = chunk
+    rng = np.random.default_rng(seed)
+    samples = rng.beta(counts + 0.5, np.maximum(totals - counts, 0) + 0.5, size=(resamples,) + counts.shape)
+    bands = np.percentile(samples * 100, [(100 - level) / 2, (100 + level) / 2], axis=0)
+    return np.where(totals > 0, bands, 0)
+
+# Low and high bands (in percent) of shares counts / totals, counts are series x bins and totals are bins
+def ShareBands(counts, totals, resamples = RESAMPLES, level = LEVEL, jobs = os.cpu_count()):
+    counts = np.asarray(counts, dtype=np.int64)
+    totals = np.broadcast_to(np.asarray(totals, dtype=np.int64), counts.shape[-1:])
+    bins_in_chunk = max(1, CHUNK_VALUES // (resamples * max(1, len(counts))))
+    seeds = np.random.SeedSequence(SEED).spawn(-(-counts.shape[1] // bins_in_chunk))
+    chunks = [(counts[:, i:i + bins_in_chunk], totals[i:i + bins_in_chunk], resamples, level, seed)
+              for seed, i in zip(seeds, range(0, counts.shape[1], bins_in_chunk))]
+    if jobs > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(jobs, len(chunks))) as pool:
+            results = pool.map(BandsChunk, chunks)
+    else:
+        results = [BandsChunk(c) for c in chunks]
+    bands = np.concatenate(results, axis=2) if results else np.zeros((2,) + counts.shape)
+    return bands[0], bands[1]
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import io
+import sys
+import json
+import time
+import argparse
+import traceback
+import functools
+import threading
+import urllib.parse
+import http.server
+import numpy as np
+import analysis_cache
+import analysis_db
+import auth_latency
+import dbaccess
+import election_meta
+import timebins
+import turnout_groups
+import vote_pyramid
+from matplotlib.figure import Figure
+from matplotlib.dates import DateFormatter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Локальный веб-сервис с графиками и данными: все данные загружаются в память один раз")
+parser.add_argument("--cache", help="Каталог локального кэша данных (см. extract_cache.py), по-умолчанию используется БД", default=None)
+parser.add_argument("--host", help="Адрес для приёма запросов, по-умолчанию 127.0.0.1", default="127.0.0.1")
+parser.add_argument("--port", type=int, help="Порт, по-умолчанию 8021", default=8021)
+parser.add_argument("--responses", type=int, help="Число ответов в кэше ответов, по-умолчанию 1024", default=1024)
+dbaccess.AddArguments(parser)
+args = parser.parse_args()
+
+# Some helper constants
+LATENCY_MS          = auth_latency.LATENCY_MS
+LOW_TURNOUT_VAL     = turnout_groups.LOW_TURNOUT_VAL
+HIGH_TURNOUT_VAL    = turnout_groups.HIGH_TURNOUT_VAL
+RENDER_LOCK         = threading.Lock()
+
+# Load everything the plots need, only aggregates and compact columns are kept
+print("Загрузка данных...")
+start = time.perf_counter()
+if args.cache:
+    meta = analysis_cache.LoadMeta(args.cache)
+    ballots_config = meta["ballots_config"]
+    total_blocks = meta["registration_blocks"]
+    votes = analysis_cache.LoadTable(args.cache, "votes")
+    auths = analysis_cache.LoadTable(args.cache, "auths")
+    issues = analysis_cache.LoadTable(args.cache, "issues")
+    vote_author, vote_ts, vote_choice = votes["author"], votes["ts"], votes["choice"]
+    auth_key, auth_ts = auths["voter_key"], auths["ts"]
+    voter_block = analysis_cache.LoadTable(args.cache, "registrations")["block"]
+    registered = issues["voter"] >= 0
+    voter_time = np.full(len(voter_block), -1, dtype=np.int64)
+    np.maximum.at(voter_time, issues["voter"][registered], issues["ts"][registered])
+else:
+    conn = dbaccess.Connect(args)
+    cur = conn.cursor()
+    ballots_config = election_meta.BallotsConfig(conn)
+    if not analysis_db.Use(cur):
+        print("Для работы с базой данных необходимы таблицы анализа, запустите build_analysis_db.py или используйте --cache")
+        sys.exit(1)
+    vote_author, vote_ts, vote_choice = dbaccess.FetchArrays(conn, "select author, ts, choice from analysis.votes", [dbaccess.BYTEA, np.int64, np.int64])
+    auth_key, auth_ts = dbaccess.FetchArrays(conn, "select voter_key, ts from analysis.auths", [dbaccess.BYTEA, np.int64])
+    voter_block, voter_time = dbaccess.FetchArrays(conn, """
+        select r.block, coalesce(i.ts, -1)
+        from analysis.registrations r
+        left join (select voter, max(ts) as ts from analysis.issues group by voter) i on i.voter = r.voter_idx
+        order by r.voter_idx""", [np.int32, np.int64])
+    cur.execute("select count(*) from analysis.blocks")
+    total_blocks = cur.fetchone()[0]
+    conn.close()
+
+# Vote-time: sparse pyramid of decrypted votes and all votes per second
+pyramid = vote_pyramid.Load(args.cache) if args.cache and vote_pyramid.Exists(args.cache) else vote_pyramid.Build(vote_choice, vote_ts)
+all_votes = timebins.BinCounts(vote_ts, 1)
+
+# Turnout: block of every voter with issued ballot and issue second
+voted = voter_time >= 0
+voted_block = np.asarray(voter_block)[voted]
+voted_second = timebins.EpochMsToBin(voter_time[voted], 1)
+block_turnout_perc = turnout_groups.BlockPercent(np.bincount(voted_block, minlength=total_blocks), np.bincount(voter_block, minlength=total_blocks))
+
+# Auth latency: dense matrix of key checks per millisecond of latency and option of the vote
+vote_idx = analysis_cache.KeyIndex(vote_author, auth_key, vote_ts)
+matched = vote_idx >= 0
+latency_options, latency_matrix = auth_latency.Build(vote_ts[vote_idx[matched]] - auth_ts[matched], vote_choice[vote_idx[matched]])
+del vote_author, auth_key, auth_ts, vote_idx, matched
+
+vote_options = {}
+option_district = {}
+for d in ballots_config:
+    vote_options.update(d["options"])
+    option_district.update({o: d["district_id"] for o in d["options"]})
+print("Данные загружены за {:.1f} с: голосов {}, избирателей {}, проверок ключей {}".format(
+    time.perf_counter() - start, len(vote_ts), len(voter_block), int(latency_matrix.sum())))
+del vote_ts, vote_choice, voter_block, voter_time
+
+class BadRequest(Exception):
+    pass
+
+# Query parameters, all values are validated here
+def IntParam(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        raise BadRequest(f"Параметр {name} должен быть целым числом")
+
+def FlagParam(params, name):
+    return params.get(name, "0") in ("1", "true", "yes")
+
+# Candidates of the request: explicit list of IDs and/or all options of a district
+def Candidates(params):
+    candidates = []
+    if "district" in params:
+        district = IntParam(params, "district", 0)
+        candidates += [int(o) for o, d in option_district.items() if d == district]
+    if "candidates" in params:
+        try:
+            candidates += [int(c) for c in params["candidates"].split(",") if c]
+        except ValueError:
+            raise BadRequest("Параметр candidates должен быть списком ID через запятую")
+    if not candidates:
+        raise BadRequest("Не заданы кандидаты: используйте параметры candidates=ID,ID... или district=номер")
+    unknown = [c for c in candidates if str(c) not in vote_options]
+    if unknown:
+        raise BadRequest(f"Неизвестные ID кандидатов: {unknown}")
+    return candidates
+
+def TimeRange(params):
+    try:
+        start = timebins.ParseMskTime(params["from"]) - timebins.EPOCH_MSK_START if "from" in params else 0
+        end = timebins.ParseMskTime(params["to"]) - timebins.EPOCH_MSK_START if "to" in params else vote_pyramid.PERIOD
+    except ValueError:
+        raise BadRequest("Время задаётся в формате 'дд.мм ЧЧ:ММ'")
+    return max(0, start), min(end, vote_pyramid.PERIOD)
+
+def BinTime(params, default):
+    bin_time = IntParam(params, "bin", default)
+    if bin_time <= 0:
+        raise BadRequest("Параметр bin должен быть положительным")
+    return bin_time
+
+# Series of every view, as dictionaries ready for JSON
+def VotesSeries(params):
+    candidates = Candidates(params)
+    bin_time = BinTime(params, 1800)
+    start, end = TimeRange(params)
+    if (end - start) // bin_time <= 0:
+        raise BadRequest("Интервал времени короче одного шага")
+    binned = vote_pyramid.Counts(pyramid, candidates, bin_time, start, end)
+    if FlagParam(params, "integrate"):
+        binned = timebins.Integrate(binned)
+    if FlagParam(params, "percentage"):
+        binned = timebins.Percentage(binned)
+    return {"start": timebins.EPOCH_MSK_START + start, "bin": bin_time,
+            "series": [{"id": c, "name": vote_options[str(c)], "values": b.tolist()} for c, b in zip(candidates, binned)]}
+
+def TurnoutSeries(params):
+    bin_time = BinTime(params, 1800)
+    low = IntParam(params, "low", LOW_TURNOUT_VAL)
+    high = IntParam(params, "high", HIGH_TURNOUT_VAL)
+    result_bins = timebins.ResultBins(bin_time)
+    turnout = block_turnout_perc[voted_block]
+    inside = (voted_second >= 0) & (voted_second < result_bins * bin_time)
+    def Histogram(mask):
+        mask = mask & inside
+        return timebins.Normalize(np.bincount(voted_second[mask] // bin_time, minlength=result_bins)).tolist()
+    votes_binned = all_votes[:result_bins * bin_time].reshape(result_bins, bin_time).sum(axis=1)
+    low_mask, high_mask, norm_mask = turnout_groups.Masks(turnout, low, high)
+    # Blocks without voters have nan turnout, it is not valid JSON
+    return {"start": timebins.EPOCH_MSK_START, "bin": bin_time,
+            "series": [{"name": f"Выдача бюллетеней, явка в блоке < {low}%, %", "values": Histogram(low_mask)},
+                       {"name": f"Выдача бюллетеней, явка в блоке > {high}%, %", "values": Histogram(high_mask)},
+                       {"name": f"Выдача бюллетеней, явка в блоке {low}-{high}%, %", "values": Histogram(norm_mask)},
+                       {"name": "Голоса, %", "values": timebins.Normalize(votes_binned).tolist()}],
+            "block_turnout": np.nan_to_num(block_turnout_perc).tolist()}
+
+def AuthtimeSeries(params):
+    candidates = Candidates(params)
+    msecs_in_bin = IntParam(params, "bin", 20)
+    if msecs_in_bin <= 0 or LATENCY_MS % msecs_in_bin:
+        raise BadRequest(f"Параметр bin должен быть делителем {LATENCY_MS}")
+    matrix = auth_latency.Rebin(latency_matrix, msecs_in_bin)
+    decrypted = auth_latency.Decrypted(latency_options, matrix)
+    rows = timebins.SeriesIndex(candidates, latency_options)
+    # Candidates without votes (all of them if no key check is matched) keep zero shares
+    found = rows >= 0
+    shares = np.zeros((len(candidates), matrix.shape[1]))
+    shares[found] = np.divide(matrix[rows[found]] * 100.0, decrypted, out=shares[found], where=decrypted != 0)
+    return {"bin": msecs_in_bin, "total": matrix.sum(axis=0).tolist(), "decrypted": decrypted.tolist(),
+            "series": [{"id": c, "name": vote_options[str(c)], "values": s.tolist()} for c, s in zip(candidates, shares)]}
+
+def Options(params):
+    district = IntParam(params, "district", 0)
+    return [{"id": int(o), "name": vote_options[o], "district": d} for o, d in option_district.items() if district in (0, d)]
+
+# Images are drawn on separate figures without pyplot, Agg rendering is serialized
+def RenderTimePlot(data, title):
+    fig = Figure(figsize=(16, 9))
+    ax = fig.add_subplot()
+    x = timebins.EpochMsToMskDatetime((data["start"] + np.arange(len(data["series"][0]["values"])) * data["bin"]) * 1000)
+    for s in data["series"]:
+        ax.plot(x, s["values"], label=s["name"])
+    ax.xaxis.set_major_formatter(DateFormatter("%d.%m %H:%M"))
+    ax.set_title(title)
+    return fig
+
+def RenderLatencyPlot(data, title):
+    fig = Figure(figsize=(16, 9))
+    axs = fig.subplots(2)
+    x = np.arange(len(data["total"])) * data["bin"]
+    axs[0].plot(x, data["total"], label="Проверок ключа с голосом")
+    for s in data["series"]:
+        axs[1].plot(x, s["values"], label=s["name"] + ", %")
+    axs[1].set_xlabel("Время между транзакцией проверки ключа избирателя и транзакцией голосования в миллисекундах")
+    axs[0].set_title(title)
+    return fig
+
+def PngResponse(fig):
+    for ax in fig.axes:
+        ax.grid()
+        ax.legend()
+    fig.tight_layout()
+    buf = io.BytesIO()
+    with RENDER_LOCK:
+        FigureCanvasAgg(fig).print_png(buf)
+    return buf.getvalue()
+
+VIEWS = {
+    "/api/options":       Options,
+    "/api/votes":         VotesSeries,
+    "/api/turnout":       TurnoutSeries,
+    "/api/authtime":      AuthtimeSeries,
+    "/plot/votes.png":    lambda p: RenderTimePlot(VotesSeries(p), "Голоса по времени"),
+    "/plot/turnout.png":  lambda p: RenderTimePlot(TurnoutSeries(p), "Выдача бюллетеней по явке в блоках регистрации"),
+    "/plot/authtime.png": lambda p: RenderLatencyPlot(AuthtimeSeries(p), "Время от проверки ключа до голоса"),
+}
+
+# Responses are cached by path and sorted query, data never changes while the server runs
+@functools.lru_cache(maxsize=args.responses)
+def Response(path, query):
+    if path not in VIEWS:
+        return 404, "application/json", json.dumps({"error": "Неизвестный путь", "paths": list(VIEWS)}, ensure_ascii=False).encode()
+    try:
+        result = VIEWS[path](dict(query))
+    except BadRequest as e:
+        return 400, "application/json", json.dumps({"error": str(e)}, ensure_ascii=False).encode()
+    if path.endswith(".png"):
+        return 200, "image/png", PngResponse(result)
+    return 200, "application/json", json.dumps(result, ensure_ascii=False).encode()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = tuple(sorted(urllib.parse.parse_qsl(url.query)))
+        # Unexpected errors are not cached by Response, the client gets JSON and the server log the traceback
+        try:
+            status, content_type, body = Response(url.path, query)
+        except Exception as e:
+            traceback.print_exc()
+            status, content_type, body = 500, "application/json", json.dumps({"error": f"Внутренняя ошибка: {e}"}, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + ("; charset=utf-8" if content_type == "application/json" else ""))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+print(f"Сервис доступен по адресу http://{args.host}:{args.port}/, пути:", " ".join(VIEWS))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,140 @@
+# Helpers for connection to the vote database and bulk reads from it.
+#
+# Fields are extracted from payload in SQL, so only the needed values are sent.
+# Queries with fixed-width columns only (integers and hex keys) are streamed
+# with COPY TO STDOUT in binary format straight into numpy arrays without
+# decoding of every value in Python, other queries use server-side cursors.
+
+import numpy as np
+import analysis_cache
+import timebins
+
+FETCH_ROWS = 100000
+
+# Column type for hex strings of keys and hashes, they are stored as raw bytes
+HEX = "hex"
+# Column type for keys already stored as bytea (see analysis_db.py)
+BYTEA = "bytea"
+
+# Binary COPY field type of fixed-width columns and SQL expression producing it
+BINARY_COLUMNS = {
+    np.int64: (">i8", "{}::int8"),
+    np.int32: (">i4", "{}::int4"),
+    HEX:      (f"S{analysis_cache.KEY_BYTES}", f"decode(coalesce({{}}, repeat('0', {2 * analysis_cache.KEY_BYTES})), 'hex')"),
+    BYTEA:    (f"S{analysis_cache.KEY_BYTES}", "{}"),
+}
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+COPY_HEADER_BYTES = len(COPY_SIGNATURE) + 8
+
+# Common connection arguments, scripts working with several databases pass dbname=None and set it themselves
+from dbargs import AddArguments, Connect
+
+# Vote config from "create vote" transaction, only the needed part of payload is fetched
+def LoadBallotsConfig(cur):
+    cur.execute("select payload->'ballots_config' from transactions where method_id=0")
+    return cur.fetchone()[0]
+
+def ConvertColumn(values, dtype):
+    if dtype == HEX:
+        return analysis_cache.HexColumn(values)
+    if dtype == BYTEA:
+        return np.array([bytes(v) for v in values], dtype=f"S{analysis_cache.KEY_BYTES}")
+    return np.array(values, dtype=dtype)
+
+# File-like sink for COPY TO STDOUT in binary format. Rows of fixed-width columns
+# have the same size, so they are converted to arrays by large chunks with numpy.
+class BinaryCopySink:
+    def __init__(self, dtypes):
+        fields = [("fields", ">i2")]
+        for i,d in enumerate(dtypes):
+            fields += [(f"len{i}", ">i4"), (f"col{i}", BINARY_COLUMNS[d][0])]
+        self.row = np.dtype(fields)
+        self.dtypes = dtypes
+        self.data = bytearray()
+        self.header = False
+        self.chunks = [[] for d in dtypes]
+
+    def write(self, data):
+        self.data += data
+        if not self.header and len(self.data) >= COPY_HEADER_BYTES:
+            if not self.data.startswith(COPY_SIGNATURE):
+                raise ValueError("Неожиданный формат данных COPY")
+            extension = int.from_bytes(self.data[COPY_HEADER_BYTES - 4:COPY_HEADER_BYTES], "big")
+            del self.data[:COPY_HEADER_BYTES + extension]
+            self.header = True
+        if self.header and len(self.data) >= FETCH_ROWS * self.row.itemsize:
+            self.Convert()
+
+    def Convert(self):
+        n = len(self.data) // self.row.itemsize
+        rows = np.frombuffer(bytes(self.data[:n * self.row.itemsize]), dtype=self.row)
+        del self.data[:n * self.row.itemsize]
+        if np.any(rows["fields"] != len(self.dtypes)):
+            raise ValueError("Неожиданное число столбцов в данных COPY")
+        for i,d in enumerate(self.dtypes):
+            # NULL has length -1 and breaks fixed-width rows, integers have to be coalesced in SQL (missing keys are zeroed)
+            if np.any(rows[f"len{i}"] != self.row[f"col{i}"].itemsize):
+                raise ValueError(f"NULL или значение неожиданной длины в столбце {i} данных COPY")
+            self.chunks[i].append(rows[f"col{i}"].astype(BINARY_COLUMNS[d][0] if d in (HEX, BYTEA) else d))
+
+    def Arrays(self):
+        self.Convert()
+        if bytes(self.data) != b"\xff\xff":
+            raise ValueError("Неожиданный конец данных COPY")
+        return [np.concatenate(c) if c else ConvertColumn((), d) for c,d in zip(self.chunks, self.dtypes)]
+
+# Streams results of a query with fixed-width columns through binary COPY into numpy arrays
+def CopyArrays(conn, query, dtypes, params = None):
+    cur = conn.cursor()
+    query = cur.mogrify(query, params).decode("utf-8")
+    names = [f"c{i}" for i in range(len(dtypes))]
+    columns = ", ".join(BINARY_COLUMNS[d][1].format(n) for n,d in zip(names, dtypes))
+    sink = BinaryCopySink(dtypes)
+    cur.copy_expert(f"COPY (select {columns} from ({query}) q({', '.join(names)})) TO STDOUT (FORMAT binary)", sink)
+    cur.close()
+    return sink.Arrays()
+
+# Streams query results into numpy arrays, one per column
+def FetchArrays(conn, query, dtypes, params = None):
+    if all(d in BINARY_COLUMNS for d in dtypes):
+        return CopyArrays(conn, query, dtypes, params)
+    cur = conn.cursor(name="fetch_arrays_cursor")
+    cur.itersize = FETCH_ROWS
+    cur.execute(query, params)
+    chunks = [[] for d in dtypes]
+    while True:
+        rows = cur.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        for i,column in enumerate(zip(*rows)):
+            chunks[i].append(ConvertColumn(column, dtypes[i]))
+    cur.close()
+    return [np.concatenate(c) if c else ConvertColumn((), d) for c,d in zip(chunks, dtypes)]
+
+# High-water mark of polled transactions: last seen time and hashes seen at exactly that time
+def NewWatermark():
+    return {"ts": -1, "hashes": set()}
+
+# Yields chunks of rows (hash, epoch ms, columns...) of transactions newer than the watermark and advances it
+# New rows are read through index transactions_method_id_datetime_idx (install/analysis_indexes.sql)
+def PollNewRows(conn, method_id, columns, watermark, joins = ""):
+    cur = conn.cursor(name="poll_cursor")
+    cur.itersize = FETCH_ROWS
+    cur.execute(f"""select t.hash, {timebins.SqlEpochMs("t.datetime")}, {columns}
+                    from transactions t {joins}
+                    where t.method_id = %s and t.datetime >= to_timestamp(%s / 1000.0)
+                    order by t.datetime, t.hash""", (method_id, max(watermark["ts"], 0)))
+    while True:
+        rows = cur.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        rows = [r for r in rows if r[1] > watermark["ts"] or r[0] not in watermark["hashes"]]
+        for r in rows:
+            if r[1] > watermark["ts"]:
+                watermark["ts"] = r[1]
+                watermark["hashes"] = set()
+            watermark["hashes"].add(r[0])
+        if rows:
+            yield rows
+    cur.close()
+    conn.commit()
@@ -0,0 +1,17 @@
+# Connection arguments of the vote database, numpy is not imported, so the
+# command line of election.py is parsed without loading of the analysis modules.
+
+def AddArguments(parser, dbname = "v2021_om"):
+    parser.add_argument("--dbaddr", help="Хост базы данных, по-умолчанию localhost", default="localhost")
+    if dbname is not None:
+        parser.add_argument("--dbname", help=f"Название базы данных, по-умолчанию {dbname}", default=dbname)
+    parser.add_argument("--dbuser", help="Пользователь базы данных, по-умолчанию postgres", default="postgres")
+    parser.add_argument("--dbpass", help="Пароль базы данных, по-умолчанию mypsqlpassword", default="mypsqlpassword")
+
+def Connect(args, dbname = None):
+    import psycopg2
+    return psycopg2.connect(
+        host=args.dbaddr,
+        user=args.dbuser,
+        password=args.dbpass,
+        database=dbname or args.dbname)
@@ -1,22 +1,31 @@
 #!/usr/bin/env python3
 # Based on https://gist.github.com/SaveTheRbtz/246eab8557b0217ab3945e15cef6ffe8
 
-import psycopg2
-import psycopg2.extras
 import json
+import io
+import os
 import sys
 import argparse
-import nacl.utils
-from nacl.public import PrivateKey, PublicKey, Box
-from choices_pb2 import Choices
+import collections
+import multiprocessing
+from nacl.public import PrivateKey
+from ballot_crypto import DecryptBallot, ENCRYPTED_CHOICE_COLUMNS
+import profiling
+import dbaccess
+import analysis_db
+import election_meta
 
 # Decode command line arguments
 parser = argparse.ArgumentParser()
-parser.add_argument("--dbaddr", help="Хост базы данных, по-умолчанию localhost", default="localhost")
-parser.add_argument("--dbname", help="Название базы данных, по-умолчанию v2021_om", default="v2021_om")
-parser.add_argument("--dbuser", help="Пользователь базы данных, по-умолчанию postgres", default="postgres")
-parser.add_argument("--dbpass", help="Пароль базы данных, по-умолчанию mypsqlpassword", default="mypsqlpassword")
+dbaccess.AddArguments(parser)
+parser.add_argument("--workers", type=int, help="Число процессов расшифровки, по-умолчанию число ядер", default=os.cpu_count())
+parser.add_argument("--batch-size", type=int, help="Число бюллетеней записываемых в БД одной транзакцией, по-умолчанию 20000", default=20000)
+parser.add_argument("--restart", action="store_true", help="Игнорировать сохранённую точку остановки и проверить все бюллетени")
+parser.add_argument("--chunk-size", type=int, help="Число бюллетеней передаваемых процессу расшифровки за раз, по-умолчанию 1000", default=1000)
+parser.add_argument("--audit", help="Вместо дорасшифровки заново расшифровать все сохранённые в БД бюллетени, сверить с decrypted_choice и записать найденные проблемы в указанный файл (JSON Lines)", default=None)
+profiling.AddArguments(parser)
 args = parser.parse_args()
+profiling.Start(args)
 
 # Helper functions
 def ErrorExit(e):
@@ -35,61 +44,218 @@ def GetVotedBallotsNumber(conn):
     voted_ballots = int(cur.fetchone()[0])
     return voted_ballots
 
+# Decryption worker, the private key is set once per process by the pool initializer
+worker_skey = None
+
+def InitWorker(hex_privatekey):
+    global worker_skey
+    worker_skey = PrivateKey(bytes.fromhex(hex_privatekey))
+
+def DecryptChunk(chunk):
+    return [(tx_hash, DecryptBallot(worker_skey, *enc)) for tx_hash, enc in chunk]
+
+# Reads not yet decrypted ballots from cursor by chunks of (hash, (public_key, encrypted_message, nonce))
+def ReadChunks(cur, chunk_size):
+    while True:
+        with profiling.Stage("read") as stage:
+            rows = cur.fetchmany(chunk_size)
+            stage["rows"] = len(rows)
+        if not rows:
+            return
+        yield [(r[0], r[1:]) for r in rows]
+
+# Checkpoint keeps the last written ballot hash, it is updated in the same transaction as ballots
+def LoadCheckpoint(conn):
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS decrypt_checkpoint (last_hash text NOT NULL)")
+    cur.execute("SELECT last_hash FROM decrypt_checkpoint")
+    row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else ""
+
+# All ballots are processed, next run should check the whole table again
+def ClearCheckpoint(conn):
+    conn.cursor().execute("DROP TABLE IF EXISTS decrypt_checkpoint")
+    conn.commit()
+
+# Writes decrypted ballots with a single COPY and commits them together with the checkpoint
+def WriteBatch(conn, batch):
+    with profiling.Stage("write") as stage:
+        buf = io.StringIO()
+        for tx_hash, choice in batch:
+            buf.write(f"{tx_hash}\t{{{choice}}}\t\"Manual\"\n")
+        buf.seek(0)
+        cur = conn.cursor()
+        cur.copy_expert("COPY decrypted_ballots(store_tx_hash,decrypted_choice,status) FROM STDIN", buf)
+        cur.execute("DELETE FROM decrypt_checkpoint")
+        cur.execute("INSERT INTO decrypt_checkpoint(last_hash) VALUES(%s)", (batch[-1][0],))
+        conn.commit()
+        stage["rows"] = len(batch)
+
+# Runs func over chunks in the pool keeping a bounded number of chunks in flight to limit memory usage,
+# yields results in order of chunks. Without the pool chunks are processed in the main process.
+def PoolMap(pool, func, chunks, workers, stage_name):
+    pending = collections.deque()
+    def Get(result, rows):
+        # Time the main process waits for workers
+        with profiling.Stage(stage_name + "_wait") as stage:
+            result = result.get()
+            stage["rows"] = rows
+        return result
+    for chunk in chunks:
+        if pool is not None:
+            pending.append((pool.apply_async(func, (chunk,)), len(chunk)))
+            if len(pending) >= workers * 2:
+                yield Get(*pending.popleft())
+        else:
+            with profiling.Stage(stage_name) as stage:
+                result = func(chunk)
+                stage["rows"] = len(chunk)
+            yield result
+    while pending:
+        yield Get(*pending.popleft())
+
+def StartPool(workers, hex_privatekey):
+    if workers == 1:
+        InitWorker(hex_privatekey)
+        return None
+    return multiprocessing.Pool(workers, initializer=InitWorker, initargs=(hex_privatekey,))
+
+# Audit of stored decryptions, returns number of checked rows and problems only: (hash, problem type, details)
+def AuditChunk(chunk):
+    problems = []
+    for tx_hash, (stored_choice, orphan, *enc) in chunk:
+        if orphan:
+            problems.append((tx_hash, "orphan", {"stored": stored_choice}))
+            continue
+        try:
+            choice = DecryptBallot(worker_skey, *enc)
+        except Exception as e:
+            problems.append((tx_hash, "undecryptable", {"stored": stored_choice, "error": f"{type(e).__name__}: {e}"}))
+            continue
+        if stored_choice != [choice]:
+            problems.append((tx_hash, "mismatch", {"stored": stored_choice, "decrypted": choice}))
+    return len(chunk), problems
+
+# Re-decrypts every stored ballot and streams found problems to the report
+def Audit(conn, pool, workers):
+    problems = collections.Counter()
+    with open(args.audit, "w") as report:
+        def Report(tx_hash, problem, details):
+            problems[problem] += 1
+            report.write(json.dumps(dict(details, hash=tx_hash, problem=problem)) + "\n")
+        # Repeated decryptions of the same ballot
+        cur = conn.cursor()
+        with profiling.Stage("audit_duplicates"):
+            cur.execute("select store_tx_hash, count(*) from decrypted_ballots group by 1 having count(*) > 1")
+            for tx_hash, count in cur:
+                Report(tx_hash, "duplicate", {"count": count})
+        # Every stored decryption with its vote transaction, joined by the server in one pass
+        cur = conn.cursor(name="audit_cursor")
+        cur.itersize = args.chunk_size
+        with profiling.Stage("query"):
+            cur.execute(f"""select d.store_tx_hash, d.decrypted_choice, t.hash is null, {ENCRYPTED_CHOICE_COLUMNS}
+                           from decrypted_ballots d left join transactions t on t.hash = d.store_tx_hash and t.method_id = 6""")
+        checked = 0
+        for chunk_checked, chunk_problems in PoolMap(pool, AuditChunk, ReadChunks(cur, args.chunk_size), workers, "audit"):
+            checked += chunk_checked
+            for p in chunk_problems:
+                Report(*p)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("Проверено расшифровок:", checked)
+    print("Несовпадений:", problems["mismatch"], "нерасшифровываемых:", problems["undecryptable"],
+          "без транзакции голоса:", problems["orphan"], "повторных:", problems["duplicate"])
+    print("Отчёт сохранён в", args.audit)
+
 # Connect to database
-conn = psycopg2.connect(
-    host=args.dbaddr,
-    user=args.dbuser,
-    password=args.dbpass,
-    database=args.dbname)
+conn = dbaccess.Connect(args)
 
 # Fetch decryption key
-cur_tmp = conn.cursor(cursor_factory = psycopg2.extras.DictCursor)  
-cur_tmp.execute("select payload from transactions where method_id=8")
-hex_privatekey = cur_tmp.fetchone()[0]['private_key']
-skey = PrivateKey(bytes.fromhex(hex_privatekey))
+hex_privatekey = election_meta.PrivateKey(conn)
+
+workers = max(1, args.workers)
+if args.audit:
+    print("Проверка сохранённых в БД расшифровок, это может занять продолжительное время...")
+    Audit(conn, StartPool(workers, hex_privatekey), workers)
+    sys.exit(0)
 
 # Check ballots number
-voted_ballots=GetVotedBallotsNumber(conn)
-inititally_decrypted_ballots=GetDecryptedBallotsNumber(conn)
+with profiling.Stage("count"):
+    voted_ballots=GetVotedBallotsNumber(conn)
+    inititally_decrypted_ballots=GetDecryptedBallotsNumber(conn)
 if voted_ballots == inititally_decrypted_ballots:
+    ClearCheckpoint(conn)
     print("База полностью расшифрована, работа не требуется")
     sys.exit(0)
-    
-# Perform decode
+
+# Perform decode, chunks are decrypted by the pool while the main process reads and writes the DB
 print("Приватный ключ голосования:", hex_privatekey)
 print("Расшифрование бюллетеней, это может занять продолжительное время...")
-cur = conn.cursor(name="cursor_name", withhold=True, cursor_factory = psycopg2.extras.DictCursor)
-cur.execute("select * from transactions where method_id=6")
-for i, row in enumerate(cur):
+last_hash = LoadCheckpoint(conn)
+if args.restart:
+    last_hash = ""
+if last_hash:
+    print("Продолжение расшифровки с бюллетеня", last_hash)
+
+# Only undecrypted ballots are selected, ordered by hash so that checkpoint is monotonic within a pass.
+# Ballots after the checkpoint go first, then ballots below it: votes added to the DB after
+# an interrupted run may have smaller hashes than the checkpoint.
+def UndecryptedChunks(last_hash):
+    passes = [("cursor_after", "t.hash > %s")] + ([("cursor_before", "t.hash <= %s")] if last_hash else [])
+    for name, condition in passes:
+        cur = conn.cursor(name=name, withhold=True)
+        cur.itersize = args.chunk_size
+        with profiling.Stage("query"):
+            cur.execute(f"""select t.hash, {ENCRYPTED_CHOICE_COLUMNS}
+                           from transactions t
+                           where t.method_id=6 and {condition}
+                             and not exists (select 1 from decrypted_ballots d where d.store_tx_hash=t.hash)
+                           order by t.hash""", (last_hash,))
+        yield from ReadChunks(cur, args.chunk_size)
+        cur.close()
+
+pool = StartPool(workers, hex_privatekey)
+batch = []
+newly_decrypted = 0
+
+def ReportProgress():
+    print("Процент расшифрованных бюллетеней в БД: {:.2f}%".format((inititally_decrypted_ballots+newly_decrypted)*100/(voted_ballots)))
+
+try:
+    for result in PoolMap(pool, DecryptChunk, UndecryptedChunks(last_hash), workers, "decrypt"):
+        batch.extend(result)
+        if len(batch) >= args.batch_size:
+            WriteBatch(conn, batch)
+            newly_decrypted += len(batch)
+            batch = []
+            ReportProgress()
+    if batch:
+        WriteBatch(conn, batch)
+        newly_decrypted += len(batch)
+        ReportProgress()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    ClearCheckpoint(conn)
+except Exception as e:
     try:
-        if (i%20000) == 0:
-            decrypted_ballots=GetDecryptedBallotsNumber(conn)
-            print("Процент расшифрованных бюллетеней в БД: {:.2f}%".format(decrypted_ballots*100/(voted_ballots)))
-        cur2 = conn.cursor()
-        cur2.execute(f"select * from decrypted_ballots where store_tx_hash='{row['hash']}'")
-        if cur2.rowcount == 0:
-            enc = row['payload']['encrypted_choice']
-            pkey = PublicKey(bytes.fromhex(enc['public_key']))
-            box = Box(skey, pkey)
-            pb = box.decrypt(bytes.fromhex(enc['encrypted_message']), bytes.fromhex(enc['nonce']))
-            offset = int.from_bytes(pb[:2], 'big')+2
-            choices = Choices().FromString(pb[offset:])
-            sql = f"""INSERT INTO decrypted_ballots(store_tx_hash,decrypted_choice,status)
-                 VALUES('{row['hash']}',array[{choices.data[0]}]::bigint[],'"Manual"');"""
-            cur2.execute(sql)
-            conn.commit()
-    except Exception as e:
-        try:
-            decrypted_ballots=GetDecryptedBallotsNumber(conn)
-            if decrypted_ballots == voted_ballots:
-                print("Все доступные в БД бюллетени расшифрованы, полное число бюллетеней:", decrypted_ballots)
-                sys.exit(0)
-            else:
-                ErrorExit(e)
-        except Exception as e:
+        conn.rollback()
+        decrypted_ballots=GetDecryptedBallotsNumber(conn)
+        if decrypted_ballots == voted_ballots:
+            ClearCheckpoint(conn)
+            print("Все доступные в БД бюллетени расшифрованы, полное число бюллетеней:", decrypted_ballots)
+            sys.exit(0)
+        else:
             ErrorExit(e)
+    except Exception as e:
+        ErrorExit(e)
 
 decrypted_ballots=GetDecryptedBallotsNumber(conn)
 if decrypted_ballots == voted_ballots:
-    print("Все доступные в БД бюллетени расшифрованы, полное число бюллетеней:", decrypted_ballots)            
-    
+    print("Все доступные в БД бюллетени расшифрованы, полное число бюллетеней:", decrypted_ballots)
+
+# Keep choices of compact analysis tables in sync with newly decrypted ballots
+if analysis_db.Exists(conn.cursor()):
+    print("Обновлено расшифрованных голосов в таблицах анализа:", analysis_db.RefreshChoices(conn))
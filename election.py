@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# Single entry point of the scripts: ./election.py <command> [options of the command]
+# Commands run the scripts in this process, so only modules of the command are imported.
+
+import os
+import sys
+import runpy
+import argparse
+import dbargs
+
+SCRIPTS = {
+    "decrypt":  ("decrypt_ballots.py", "Дорасшифровывание бюллетеней в БД"),
+    "timeplot": ("time_plot.py", "График распределения голосов по времени"),
+    "turnout":  ("turnout_plot.py", "Графики явки по блокам регистрации избирателей"),
+    "authtime": ("authtime_plot.py", "График задержек между проверкой ключа и голосованием"),
+}
+
+parser = argparse.ArgumentParser(description="Анализ данных ДЭГ, полный help команды: ./election.py <команда> -h")
+commands = parser.add_subparsers(dest="command", required=True, metavar="команда")
+for name, (script, description) in SCRIPTS.items():
+    # Options are parsed by the script itself
+    commands.add_parser(name, help=f"{description} ({script})", add_help=False)
+list_parser = commands.add_parser("list", help="Вывести ID и имена кандидатов")
+list_parser.add_argument("district", type=int, nargs="?", help="Номер округа, по-умолчанию 0 - все округа", default=0)
+list_parser.add_argument("--cache", help="Каталог локального кэша данных (см. extract_cache.py), по-умолчанию используется БД", default=None)
+dbargs.AddArguments(list_parser)
+args, script_args = parser.parse_known_args()
+
+if args.command in SCRIPTS:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SCRIPTS[args.command][0])
+    sys.argv = [script] + script_args
+    runpy.run_path(script, run_name="__main__")
+    sys.exit(0)
+
+# Options are listed from metadata cached on disk, see election_meta.py
+import election_meta
+args = parser.parse_args()
+if args.cache:
+    ballots_config = election_meta.CacheBallotsConfig(args.cache)
+else:
+    ballots_config = election_meta.BallotsConfig(dbargs.Connect(args))
+election_meta.PrintOptions(ballots_config, args.district)
@@ -0,0 +1,75 @@
+# Election metadata cached on disk: ballots config (districts and options) and decryption key.
+#
+# Ballots config is parsed from the payload of "create vote" transaction and the
+# key is published in a transaction of its own, both queries scan transactions.
+# Metadata never changes in a database, so it is saved to a JSON file named by
+# the database identity: host, port, name and oid of the database (a database
+# imported again gets a new oid) and hash of the "create vote" transaction (a
+# database regenerated in place by synth_db.py keeps its oid). Analysis,
+# plotting and decryption modules are imported only on the first access, so
+# listing of options does not wait for them.
+
+import os
+import re
+import json
+
+CACHE_DIR           = os.path.join(os.path.expanduser("~"), ".cache", "election2021_msk")
+
+def Identity(conn):
+    cur = conn.cursor()
+    cur.execute("select oid from pg_database where datname = current_database()")
+    oid = cur.fetchone()[0]
+    # Read through transactions_method_id_idx (install/analysis_indexes.sql)
+    cur.execute("select hash from transactions where method_id=0 limit 1")
+    row = cur.fetchone()
+    identity = f"{conn.info.host}_{conn.info.port}_{conn.info.dbname}_{oid}_{row[0] if row else 'empty'}"
+    return re.sub(r"[^\w.-]", "_", identity)
+
+def Load(conn):
+    path = os.path.join(CACHE_DIR, Identity(conn) + ".json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    # Database helpers import numpy, decryption helpers nacl and protobuf, they are needed only on the first run
+    import dbaccess
+    import ballot_crypto
+    cur = conn.cursor()
+    meta = {"ballots_config": dbaccess.LoadBallotsConfig(cur)}
+    cur.execute("select count(*) from transactions where method_id=8")
+    meta["private_key"] = ballot_crypto.LoadPrivateKey(cur) if cur.fetchone()[0] else None
+    conn.commit()
+    # Key is not published until the end of voting, metadata without it is not saved
+    if meta["private_key"] is not None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    return meta
+
+def BallotsConfig(conn):
+    return Load(conn)["ballots_config"]
+
+# Ballots config of a local cache, read from its meta.json without analysis_cache (and numpy)
+def CacheBallotsConfig(cache_dir):
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        return json.load(f)["ballots_config"]
+
+def PrivateKey(conn):
+    key = Load(conn)["private_key"]
+    if key is None:
+        raise ValueError("Ключ расшифровки ещё не опубликован в БД")
+    return key
+
+# Options of all districts, ID -> name
+def VoteOptions(ballots_config):
+    vote_options = {}
+    for d in ballots_config:
+        vote_options.update(d["options"])
+    return vote_options
+
+# Prints IDs and names of options of the district, 0 - of all districts
+def PrintOptions(ballots_config, district):
+    for d in ballots_config:
+        if (district == 0) or (d["district_id"] == district):
+            for o in d["options"]:
+                print(o, ":", d["options"][o])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import argparse
+import numpy as np
+import analysis_cache
+import dbaccess
+import timebins
+import vote_pyramid
+
+# Parse command line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("-o", action="store", help="Каталог для сохранения локального кэша данных, по-умолчанию cache", default="cache")
+dbaccess.AddArguments(parser)
+args = parser.parse_args()
+
+# Connect to database
+conn = dbaccess.Connect(args)
+
+# Election metadata
+cur = conn.cursor()
+ballots_config = dbaccess.LoadBallotsConfig(cur)
+cur.execute("select count(*) from transactions where method_id=1")
+registration_blocks = cur.fetchone()[0]
+analysis_cache.SaveMeta(args.o, {"dbname": args.dbname, "ballots_config": ballots_config, "registration_blocks": registration_blocks})
+
+# Votes with decrypted choices
+print("Выгрузка голосов...")
+hashes, ts, authors, choices = dbaccess.FetchArrays(conn, f"""select t.hash, {timebins.SqlEpochMs("t.datetime")}, t.author, coalesce(d.decrypted_choice[1], {analysis_cache.NO_CHOICE})
+                                                              from transactions t left join decrypted_ballots d on d.store_tx_hash = t.hash
+                                                              where t.method_id=6""", [dbaccess.HEX, np.int64, dbaccess.HEX, np.int64])
+analysis_cache.SaveTable(args.o, "votes", {"hash": hashes, "ts": ts, "author": authors, "choice": choices})
+vote_pyramid.Save(args.o, vote_pyramid.Build(choices, ts))
+print("Голосов:", len(hashes))
+del hashes, ts, authors, choices
+
+# Registration blocks are numbered in order of time and hash (as in analysis_db.py), voters in order
+# of registration. The numbering is kept in a temporary table, so issued ballots are matched to voters by the server.
+print("Выгрузка блоков регистрации избирателей...")
+cur.execute("""create temporary table registered_voters as
+               select row_number() over (order by b.idx, v.n) - 1 as voter_idx, b.idx as block, v.voter
+               from (select row_number() over (order by datetime, hash) - 1 as idx, payload from transactions where method_id=1) b,
+                    jsonb_array_elements_text(b.payload->'voters') with ordinality v(voter, n)""")
+cur.execute("analyze registered_voters")
+blocks, = dbaccess.FetchArrays(conn, "select block from registered_voters order by voter_idx", [np.int32])
+analysis_cache.SaveTable(args.o, "registrations", {"block": blocks})
+print("Зарегистрированных избирателей:", len(blocks))
+del blocks
+
+# Issued ballots, voters missing in registration blocks get -1 (last registration for duplicates)
+print("Выгрузка выданных бюллетеней...")
+issue_voters, ts = dbaccess.FetchArrays(conn, f"""select coalesce(r.voter_idx, -1), {timebins.SqlEpochMs("t.datetime")}
+                                                 from transactions t left join (select voter, max(voter_idx) as voter_idx from registered_voters group by voter) r
+                                                   on r.voter = t.payload->>'voter_id'
+                                                 where t.method_id=4""", [np.int32, np.int64])
+analysis_cache.SaveTable(args.o, "issues", {"voter": issue_voters, "ts": ts})
+print("Выданных бюллетеней:", len(issue_voters))
+del issue_voters, ts
+
+# Voter key checks
+print("Выгрузка проверок ключей избирателей...")
+keys, ts = dbaccess.FetchArrays(conn, f"select payload->>'voter_key', {timebins.SqlEpochMs()} from transactions where method_id=5",
+                                [dbaccess.HEX, np.int64])
+analysis_cache.SaveTable(args.o, "auths", {"voter_key": keys, "ts": ts})
+print("Проверок ключей:", len(keys))
+
+print("Кэш сохранён в", args.o)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import gzip
+import json
+import hashlib
+import calendar
+import argparse
+import numpy as np
+import analysis_cache
+import vote_pyramid
+
+# Parse command line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("dump", help="Путь до скачанного gzip SQL-дампа базы данных")
+parser.add_argument("-o", action="store", help="Каталог для сохранения локального кэша данных, по-умолчанию cache", default="cache")
+args = parser.parse_args()
+
+# SHA256 of decompressed dumps published in README
+KNOWN_CHECKSUMS = {
+    "af3ca1f9002a7bc92065fd696e642fca84691dff7a3d8ee5165c009513082c66": "одномандатные округа",
+    "63f0cea15928ed31b1dceaaa74d2651fd901be17624bd2435ea925037fa3abec": "партийные списки",
+}
+
+READ_BLOCK = 1 << 20
+COPY_HEADER = re.compile(r"^COPY (?:\w+\.)?(\w+) \(([^)]*)\) FROM stdin;$")
+COPY_ESCAPE = re.compile(r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))")
+COPY_TIMESTAMP = re.compile(r"^(\d+)-(\d+)-(\d+) (\d+):(\d+):(\d+)(?:\.(\d+))?(?:([+-])(\d+)(?::(\d+))?)?$")
+COPY_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+# Reads decompressed dump by lines and hashes every byte of it on the way
+def HashedLines(f, sha):
+    tail = b""
+    while True:
+        block = f.read(READ_BLOCK)
+        if not block:
+            break
+        sha.update(block)
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+# Decodes a field of COPY text format
+def CopyUnescape(field):
+    if field == "\\N":
+        return None
+    if "\\" not in field:
+        return field
+    def Replace(m):
+        if m.group(1):
+            return chr(int(m.group(1), 8))
+        if m.group(2):
+            return chr(int(m.group(2), 16))
+        return COPY_ESCAPES.get(m.group(3), m.group(3))
+    return COPY_ESCAPE.sub(Replace, field)
+
+# Parses timestamptz text of the dump, timestamps without zone are taken as UTC
+def TimeToEpochUs(t):
+    m = COPY_TIMESTAMP.match(t)
+    secs = calendar.timegm(tuple(int(v) for v in m.group(1, 2, 3, 4, 5, 6)))
+    if m.group(8):
+        offset = int(m.group(9)) * 3600 + int(m.group(10) or 0) * 60
+        secs -= offset if m.group(8) == "+" else -offset
+    return secs * 1000000 + int((m.group(7) or "0")[:6].ljust(6, "0"))
+
+def TimeToEpochMs(t):
+    return TimeToEpochUs(t) // 1000
+
+# Only the fields used by the analyses are kept
+ballots_config = None
+registrations = []
+votes = {"hash": [], "ts": [], "author": []}
+issues = {"voter": [], "ts": []}
+auths = {"voter_key": [], "ts": []}
+decrypted = {"hash": [], "choice": []}
+
+def ProcessTransaction(row):
+    global ballots_config
+    method_id = int(row["method_id"])
+    if method_id == 6:
+        votes["hash"].append(row["hash"])
+        votes["ts"].append(TimeToEpochMs(row["datetime"]))
+        votes["author"].append(row["author"])
+    elif method_id == 5:
+        auths["voter_key"].append(json.loads(CopyUnescape(row["payload"]))["voter_key"])
+        auths["ts"].append(TimeToEpochMs(row["datetime"]))
+    elif method_id == 4:
+        issues["voter"].append(str(json.loads(CopyUnescape(row["payload"]))["voter_id"]))
+        issues["ts"].append(TimeToEpochMs(row["datetime"]))
+    elif method_id == 1:
+        registrations.append((TimeToEpochUs(row["datetime"]), row["hash"], [str(v) for v in json.loads(CopyUnescape(row["payload"]))["voters"]]))
+    elif method_id == 0:
+        ballots_config = json.loads(CopyUnescape(row["payload"]))["ballots_config"]
+
+def ProcessDecryptedBallot(row):
+    decrypted["hash"].append(row["store_tx_hash"])
+    decrypted["choice"].append(int(row["decrypted_choice"].strip("{}").split(",")[0]))
+
+TABLE_PROCESSORS = {
+    "transactions": ProcessTransaction,
+    "decrypted_ballots": ProcessDecryptedBallot,
+}
+
+# Stream the dump, rows of interesting COPY blocks are parsed on the fly
+print("Чтение дампа", args.dump, "это может занять продолжительное время...")
+sha = hashlib.sha256()
+processor = None
+with gzip.open(args.dump, "rb") as f:
+    for i, line in enumerate(HashedLines(f, sha)):
+        if processor is not None:
+            if line == b"\\.":
+                processor = None
+                continue
+            processor(dict(zip(columns, line.decode("utf-8").split("\t"))))
+        elif line.startswith(b"COPY "):
+            m = COPY_HEADER.match(line.decode("utf-8"))
+            if m and m.group(1) in TABLE_PROCESSORS:
+                processor = TABLE_PROCESSORS[m.group(1)]
+                columns = [c.strip().strip('"') for c in m.group(2).split(",")]
+                print("Чтение таблицы", m.group(1))
+        if (i % 1000000) == 0 and i > 0:
+            print("Прочитано строк:", i)
+
+checksum = sha.hexdigest()
+print("SHA256 распакованного дампа:", checksum)
+if checksum in KNOWN_CHECKSUMS:
+    print("Чексумма совпадает с опубликованной для дампа:", KNOWN_CHECKSUMS[checksum])
+else:
+    print("Чексумма не совпадает ни с одной из опубликованных, дамп может быть повреждён или относиться к другому голосованию")
+
+if ballots_config is None:
+    print("В дампе не найдена транзакция создания голосования, возможно дамп повреждён")
+    sys.exit(1)
+
+# Registration blocks are numbered in order of time and hash (as in analysis_db.py), voters in order of registration
+registrations.sort(key=lambda r: r[:2])
+registration_blocks = len(registrations)
+registered_voters = [v for r in registrations for v in r[2]]
+registered_blocks = [b for b, r in enumerate(registrations) for v in r[2]]
+del registrations
+
+# Join decrypted choices to votes by hash
+vote_hashes = analysis_cache.HexColumn(votes["hash"])
+choices = np.full(len(vote_hashes), analysis_cache.NO_CHOICE, dtype=np.int64)
+decrypted_idx = analysis_cache.KeyIndex(analysis_cache.HexColumn(decrypted["hash"]), vote_hashes)
+found = decrypted_idx >= 0
+choices[found] = np.array(decrypted["choice"], dtype=np.int64)[decrypted_idx[found]]
+
+# Save analysis-ready cache
+analysis_cache.SaveMeta(args.o, {"dbname": args.dump, "sha256": checksum, "ballots_config": ballots_config, "registration_blocks": registration_blocks})
+analysis_cache.SaveTable(args.o, "votes", {
+    "hash": vote_hashes,
+    "ts": np.array(votes["ts"], dtype=np.int64),
+    "author": analysis_cache.HexColumn(votes["author"]),
+    "choice": choices})
+vote_pyramid.Save(args.o, vote_pyramid.Build(choices, votes["ts"]))
+analysis_cache.SaveTable(args.o, "registrations", {"block": np.array(registered_blocks, dtype=np.int32)})
+analysis_cache.SaveTable(args.o, "issues", {
+    "voter": analysis_cache.EncodeVoters(registered_voters, issues["voter"]),
+    "ts": np.array(issues["ts"], dtype=np.int64)})
+analysis_cache.SaveTable(args.o, "auths", {
+    "voter_key": analysis_cache.HexColumn(auths["voter_key"]),
+    "ts": np.array(auths["ts"], dtype=np.int64)})
+print("Голосов:", len(vote_hashes), "из них расшифровано:", int(np.count_nonzero(choices != analysis_cache.NO_CHOICE)))
+print("Кэш сохранён в", args.o)
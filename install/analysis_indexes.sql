@@ -0,0 +1,9 @@
+-- Indexes for access paths of decrypt_ballots.py and plot scripts, one statement per line
+CREATE INDEX IF NOT EXISTS transactions_method_id_idx ON transactions (method_id);
+CREATE INDEX IF NOT EXISTS transactions_method_id_datetime_idx ON transactions (method_id, datetime);
+CREATE INDEX IF NOT EXISTS transactions_hash_idx ON transactions (hash);
+CREATE INDEX IF NOT EXISTS transactions_author_idx ON transactions (author);
+CREATE INDEX IF NOT EXISTS transactions_voter_id_idx ON transactions ((payload->'voter_id')) WHERE method_id = 4;
+CREATE INDEX IF NOT EXISTS transactions_voter_key_idx ON transactions ((payload->'voter_key')) WHERE method_id = 5;
+CREATE INDEX IF NOT EXISTS decrypted_ballots_store_tx_hash_idx ON decrypted_ballots (store_tx_hash);
+CREATE INDEX IF NOT EXISTS decrypted_ballots_choice_idx ON decrypted_ballots ((decrypted_choice[1]));
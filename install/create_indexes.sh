@@ -0,0 +1,21 @@
+#!/usr/bin/env bash
+
+set -e
+
+if [ "$#" -lt 1 ]; then
+	echo "Usage: $0 <db-name> [parallel-jobs]"
+	exit 1
+fi
+
+DB=$1
+JOBS=${2:-$(nproc)}
+SQL_DIR=$(dirname "$(readlink -f "$0")")
+
+echo "Создание индексов для анализа в базе данных $DB ($JOBS параллельных процессов)..."
+
+# Every index is built by its own connection
+grep -v '^--' "$SQL_DIR/analysis_indexes.sql" | grep . | \
+	xargs -d '\n' -P "$JOBS" -I{} sh -c 'echo "$1" | sudo -u postgres -i psql -q -v ON_ERROR_STOP=1 "$2"' _ {} "$DB"
+
+echo "Сбор статистики..."
+echo "ANALYZE" | sudo -u postgres -i psql -q "$DB"
@@ -2,13 +2,60 @@
 
 set -e
 
+FAST=0
+if [ "$1" == "--fast" ]; then
+	FAST=1
+	shift
+fi
+
 if [ "$#" != 2 ]; then
-	echo "Usage: $0 <gzipped-sql-dump-file-path> <db-name>"
+	echo "Usage: $0 [--fast] <gzipped-sql-dump-file-path> <db-name>"
+	echo "  --fast - загрузить данные без индексов и ограничений, построить их после загрузки параллельно"
 	exit 1
 fi
 
 echo "Создание базы данных $2 и её импорт из дампа $1. Процесс может занять продолжительное время..."
 
 echo "CREATE DATABASE $2" | sudo -u postgres -i psql
-zcat $1 | sudo -u postgres -i psql $2
-	
+
+if [ "$FAST" == 0 ]; then
+	zcat $1 | sudo -u postgres -i psql $2
+	exit 0
+fi
+
+# Runs SQL statements from stdin (one per line) in parallel connections
+JOBS=$(nproc)
+RunParallel() {
+	xargs -d '\n' -r -P "$JOBS" -I{} sh -c 'echo "$1" | sudo -u postgres -i psql -q -v ON_ERROR_STOP=1 "$2"' _ {} "$1"
+}
+
+# Index and constraint statements are cut out of the dump and deferred until all data is loaded
+POST_DATA=$(mktemp)
+trap 'rm -f "$POST_DATA"' EXIT
+chmod a+r "$POST_DATA"
+{
+	echo "SET synchronous_commit = off;"
+	echo "SET maintenance_work_mem = '1GB';"
+	zcat $1 | awk -v post="$POST_DATA" '
+		in_copy { print; if ($0 == "\\.") in_copy = 0; next }
+		/^COPY .* FROM stdin;$/ { in_copy = 1; print; next }
+		stmt != "" { stmt = stmt " " $0; if ($0 ~ /;$/) { print stmt > post; stmt = "" }; next }
+		held != "" {
+			if ($0 ~ /^ +ADD CONSTRAINT /) {
+				stmt = held " " $0; held = ""
+				if ($0 ~ /;$/) { print stmt > post; stmt = "" }
+				next
+			}
+			print held; held = ""
+		}
+		/^CREATE (UNIQUE )?INDEX / { stmt = $0; if ($0 ~ /;$/) { print stmt > post; stmt = "" }; next }
+		/^ALTER TABLE ONLY [^ ]+$/ { held = $0; next }
+		{ print }
+		END { if (held != "") print held }'
+} | sudo -u postgres -i psql -q $2
+
+echo "Данные загружены, построение индексов и ограничений из дампа..."
+grep -v "FOREIGN KEY" "$POST_DATA" | RunParallel $2
+grep "FOREIGN KEY" "$POST_DATA" | RunParallel $2
+
+"$(dirname "$(readlink -f "$0")")/create_indexes.sh" $2 "$JOBS"
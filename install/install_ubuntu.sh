@@ -2,7 +2,7 @@
 
 # Installs all required packages for vote DB & plot builder
 sudo apt update
-sudo apt install -y postgresql python3-psycopg2 python3-googleapi python3-nacl python3-matplotlib python3-pip
+sudo apt install -y postgresql python3-psycopg2 python3-googleapi python3-nacl python3-matplotlib python3-numpy python3-pip
 pip install --upgrade --user protobuf
 
 # Reset PosgreSQL password
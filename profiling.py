@@ -0,0 +1,111 @@
+# Per-stage profiling of the scripts.
+#
+# Scripts wrap their stages with "with profiling.Stage(name) as stage:" and may
+# set stage["rows"] to the number of processed rows. Repeated stages (e.g. per
+# batch) are accumulated. With --profile REPORT wall time, rows/sec and memory
+# of every stage are saved to a JSON report on exit, --cprofile FILE saves
+# cProfile stats of the main process for "python -m pstats". Memory of a stage
+# is the growth of peak RSS during its calls (peak_rss_growth_mb), the stage
+# that sets a new peak gets it; peak_rss_mb is the peak of the process so far.
+
+import io
+import os
+import sys
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import resource
+import contextlib
+from datetime import datetime
+
+TOP_FUNCTIONS = 30
+
+run_start = time.perf_counter()
+started = datetime.now().isoformat(timespec="seconds")
+stages = {}
+profiler = None
+
+def AddArguments(parser):
+    parser.add_argument("--profile", help="Сохранить в JSON файл время работы, скорость обработки строк и пик памяти по этапам", default=None)
+    parser.add_argument("--cprofile", help="Сохранить статистику cProfile основного процесса в файл (для python -m pstats)", default=None)
+
+def Start(args):
+    global profiler
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(SaveCProfile, args.cprofile)
+    if args.profile:
+        # Registered last so that it runs first and cProfile is still collecting
+        atexit.register(SaveReport, args.profile)
+
+# Peak resident memory in MBytes, ru_maxrss is in KBytes on Linux and in bytes on macOS
+def PeakRssMb(who = resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+def CpuSeconds(who = resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+@contextlib.contextmanager
+def Stage(name):
+    stage = {"rows": 0}
+    start = time.perf_counter()
+    cpu_start = CpuSeconds()
+    rss_start = PeakRssMb()
+    try:
+        yield stage
+    finally:
+        total = stages.setdefault(name, {"calls": 0, "seconds": 0.0, "cpu_seconds": 0.0, "rows": 0, "peak_rss_growth_mb": 0.0})
+        total["calls"] += 1
+        total["seconds"] += time.perf_counter() - start
+        total["cpu_seconds"] += CpuSeconds() - cpu_start
+        total["rows"] += stage["rows"]
+        total["peak_rss_mb"] = PeakRssMb()
+        total["peak_rss_growth_mb"] = round(total["peak_rss_growth_mb"] + total["peak_rss_mb"] - rss_start, 1)
+
+def Report():
+    result = []
+    for name, s in stages.items():
+        s = dict(s, name=name, seconds=round(s["seconds"], 3), cpu_seconds=round(s["cpu_seconds"], 3))
+        s["rows_per_sec"] = round(s["rows"] / s["seconds"]) if s["rows"] and s["seconds"] > 0 else None
+        result.append(s)
+    return {
+        "script": os.path.basename(sys.argv[0]),
+        "argv": sys.argv[1:],
+        "started": started,
+        "total_seconds": round(time.perf_counter() - run_start, 3),
+        "cpu_seconds": round(CpuSeconds(), 3),
+        "children_cpu_seconds": round(CpuSeconds(resource.RUSAGE_CHILDREN), 3),
+        "peak_rss_mb": PeakRssMb(),
+        "children_peak_rss_mb": PeakRssMb(resource.RUSAGE_CHILDREN),
+        "stages": result,
+    }
+
+# Functions with the largest cumulative time, to keep them in the JSON report
+def TopFunctions():
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    stats.sort_stats("cumulative")
+    top = []
+    for func in stats.fcn_list[:TOP_FUNCTIONS]:
+        calls, primitive_calls, tottime, cumtime, callers = stats.stats[func]
+        top.append({"function": f"{func[0]}:{func[1]}({func[2]})", "calls": calls,
+                    "tottime": round(tottime, 3), "cumtime": round(cumtime, 3)})
+    return top
+
+def SaveReport(path):
+    report = Report()
+    if profiler is not None:
+        profiler.disable()
+        report["top_functions"] = TopFunctions()
+    with open(path, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print("Отчёт профилирования сохранён в", path)
+
+def SaveCProfile(path):
+    profiler.disable()
+    profiler.dump_stats(path)
+    print("Статистика cProfile сохранена в", path)
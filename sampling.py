@@ -0,0 +1,55 @@
+# Hash-based sampling of transactions for fast approximate previews (--sample).
+#
+# A row is in the sample if the first 16 bits of its key (transaction hash,
+# voter key...) are below a threshold. Keys are hashes, so the sample is
+# uniform and the same in every run. Unlike TABLESAMPLE it is consistent
+# between tables: a voter key sampled in key checks is sampled in votes too,
+# so joins of sampled tables stay exact. The condition is a range of the key
+# (key < first 16 bits of the bound), so only the sampled rows are read through
+# the index of the key column (install/analysis_indexes.sql, analysis_db.py).
+
+import numpy as np
+import dbaccess
+
+KEY_VALUES = 1 << 16
+
+# Column type for hex strings of keys inside jsonb payload, e.g. payload->'voter_key'
+JSON = "json"
+
+def AddArguments(parser):
+    parser.add_argument("--sample", type=float, help="Быстрая приблизительная оценка по выборке SAMPLE процентов транзакций в БД (например 1), числа пересчитываются на все данные, на графиках показывается погрешность выборки", default=None)
+
+def Threshold(percent):
+    return max(1, min(KEY_VALUES, round(percent * KEY_VALUES / 100)))
+
+# Actual sampled fraction, percent is rounded to whole 16-bit key values
+def Fraction(percent):
+    return Threshold(percent) / KEY_VALUES
+
+# SQL condition selecting sampled rows by key column of dbaccess.HEX, dbaccess.BYTEA or JSON type, "true" if not sampling.
+# Lowercase hex digits sort in the same order in all usual collations, so text keys are compared as is.
+def Condition(column, dtype, percent):
+    if percent is None or Threshold(percent) >= KEY_VALUES:
+        return "true"
+    bound = f"{Threshold(percent):04x}"
+    if dtype == dbaccess.BYTEA:
+        return f"{column} < '\\x{bound}'::bytea"
+    if dtype == JSON:
+        return f"{column} < to_jsonb('{bound}'::text)"
+    return f"{column} < '{bound}'"
+
+# Counts of the sample scaled to all data and standard error of the estimate
+def ScaleCounts(counts, percent):
+    fraction = Fraction(percent)
+    counts = np.asarray(counts, dtype=np.float64)
+    return counts / fraction, np.sqrt(counts * (1 - fraction)) / fraction
+
+# Printable estimate of a count in all data by its count in the sample
+def Estimate(count, percent):
+    if percent is None:
+        return count
+    scaled, error = ScaleCounts(count, percent)
+    return "≈{:.0f} ± {:.0f}".format(scaled, 2 * error)
+
+def Describe(percent):
+    return "Используется выборка {:.2f}% транзакций, числа пересчитаны на все данные, погрешность указана для 95% доверительного интервала".format(Fraction(percent) * 100)
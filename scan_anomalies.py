@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import analysis_cache
+import analysis_db
+import dbaccess
+import election_meta
+import timebins
+import profiling
+import vote_pyramid
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Поиск аномалий в распределении голосов по времени для всех кандидатов всех округов")
+parser.add_argument("--cache", help="Каталог локального кэша данных (см. extract_cache.py), по-умолчанию используется БД", default=None)
+parser.add_argument("--minutes-in-bin", type=int, help="Число минут на точку распределения, по-умолчанию 10", default=10)
+parser.add_argument("--reference", help="JSON-файл графика (например sobyanin_list.json), с кандидатами которого считается корреляция", default=None)
+parser.add_argument("--sort", choices=["deviation", "change", "reference"], help="Столбец для сортировки: deviation - отклонение от профиля округа, change - скачок доли, reference - корреляция с эталонными кандидатами; по-умолчанию deviation", default="deviation")
+parser.add_argument("--min-votes", type=int, help="Не включать в таблицу кандидатов с меньшим числом голосов (их оценки неустойчивы), по-умолчанию 100", default=100)
+parser.add_argument("--top", type=int, help="Число выводимых строк таблицы, по-умолчанию 30", default=30)
+parser.add_argument("-o", action="store", help="Сохранить полную таблицу в CSV файл", default=None)
+parser.add_argument("--jobs", type=int, help="Число процессов, по-умолчанию число ядер", default=os.cpu_count())
+dbaccess.AddArguments(parser)
+profiling.AddArguments(parser)
+args = parser.parse_args()
+if args.sort == "reference" and not args.reference:
+    print("Для сортировки по корреляции необходимо задать --reference")
+    sys.exit(1)
+profiling.Start(args)
+
+# Some helper constants
+BIN_TIME            = args.minutes_in_bin * 60
+RESULT_BINS         = timebins.ResultBins(BIN_TIME)
+ROWS_IN_CHUNK       = 64
+
+# Vote histograms of all options, options x bins
+def LoadHistograms(options):
+    if args.cache and vote_pyramid.Exists(args.cache):
+        return vote_pyramid.Counts(vote_pyramid.Load(args.cache), options, BIN_TIME)
+    if args.cache:
+        votes = analysis_cache.LoadTable(args.cache, "votes")
+        return timebins.SeriesBinCounts(votes["ts"], timebins.SeriesIndex(votes["choice"], options), len(options), BIN_TIME)
+    if analysis_db.Exists(cur):
+        query = """select choice, (ts / 1000 - %(start)s) / %(bin_time)s, count(*)
+                   from analysis.votes
+                   where choice <> -1 and ts >= %(start)s * 1000 and ts < %(end)s * 1000
+                   group by 1, 2"""
+    else:
+        query = """select d.decrypted_choice[1], floor((extract(epoch from t.datetime) - %(start)s) / %(bin_time)s), count(*)
+                   from decrypted_ballots d join transactions t on t.hash = d.store_tx_hash
+                   where t.method_id = 6 and t.datetime >= to_timestamp(%(start)s) and t.datetime < to_timestamp(%(end)s)
+                   group by 1, 2"""
+    choice, bins, counts = dbaccess.FetchArrays(conn, query, [np.int64, np.int64, np.int64],
+                                                {"start": timebins.EPOCH_MSK_START, "end": timebins.EPOCH_MSK_START + RESULT_BINS * BIN_TIME, "bin_time": BIN_TIME})
+    series = timebins.SeriesIndex(choice, options)
+    histograms = np.zeros((len(options), RESULT_BINS), dtype=np.int64)
+    np.add.at(histograms, (series[series >= 0], bins[series >= 0]), counts[series >= 0])
+    return histograms
+
+# Scan worker, the reference profile is set once per process by the pool initializer
+worker_reference = None
+
+def InitWorker(reference):
+    global worker_reference
+    worker_reference = reference
+
+# Unit-norm centered rows, zero rows stay zero
+def NormalizeRows(x):
+    x = x - x.mean(axis=1, keepdims=True)
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    return np.divide(x, norm, out=np.zeros_like(x), where=norm != 0)
+
+# Binomial z-scores of counts against the district profile scaled by the option share
+def DeviationZ(counts, district):
+    total = counts.sum(axis=1, keepdims=True)
+    district_total = district.sum(axis=1, keepdims=True)
+    share = np.divide(total, district_total, out=np.zeros_like(total), where=district_total != 0)
+    expected = district * share
+    variance = expected * (1 - share)
+    z = np.divide(counts - expected, np.sqrt(variance), out=np.zeros_like(counts), where=variance > 0)
+    return z, variance, share
+
+# Scores of a chunk of options against their district profiles (sum of all options of the district):
+#   deviation - z-scores of counts against the district profile scaled by the option share (binomial),
+#               maximum |z|, its bin and chi-square per degree of freedom
+#   change    - best single change point of the share in the district, two-proportion z-score over all splits
+#   reference - correlation of deviation z-profile with the mean profile of reference options (excluding itself)
+def ScanChunk(chunk):
+    counts, district, in_reference = chunk
+    counts = counts.astype(np.float64)
+    district = district.astype(np.float64)
+    z, variance, share = DeviationZ(counts, district)
+    dof = np.maximum(np.count_nonzero(variance > 0, axis=1) - 1, 1)
+    deviation_bin = np.abs(z).argmax(axis=1)
+
+    # Share before and after every split point from cumulative sums
+    before, district_before = np.cumsum(counts, axis=1)[:, :-1], np.cumsum(district, axis=1)[:, :-1]
+    after, district_after = counts.sum(axis=1, keepdims=True) - before, district.sum(axis=1, keepdims=True) - district_before
+    share_before = np.divide(before, district_before, out=np.zeros_like(before), where=district_before != 0)
+    share_after = np.divide(after, district_after, out=np.zeros_like(after), where=district_after != 0)
+    pooled = share * (1 - share)
+    scale = np.sqrt(pooled * (np.divide(1, district_before, out=np.zeros_like(before), where=district_before != 0) +
+                              np.divide(1, district_after, out=np.zeros_like(after), where=district_after != 0)))
+    change_z = np.divide(share_after - share_before, scale, out=np.zeros_like(before),
+                         where=(scale > 0) & (district_before > 0) & (district_after > 0))
+    change_bin = np.abs(change_z).argmax(axis=1)
+    rows = np.arange(len(counts))
+
+    result = {
+        "deviation": np.abs(z)[rows, deviation_bin],
+        "deviation_bin": deviation_bin,
+        "chi2": (z ** 2).sum(axis=1) / dof,
+        "change": change_z[rows, change_bin],
+        "change_bin": change_bin + 1,
+        "share_before": share_before[rows, change_bin] * 100,
+        "share_after": share_after[rows, change_bin] * 100,
+    }
+    if worker_reference is not None:
+        profile_sum, members = worker_reference
+        normalized = NormalizeRows(z)
+        others = profile_sum - normalized * in_reference[:, None]
+        result["reference"] = (normalized * others).sum(axis=1) / np.maximum(members - in_reference, 1)
+    return result
+
+# All options of all districts
+if args.cache:
+    ballots_config = analysis_cache.LoadMeta(args.cache)["ballots_config"]
+else:
+    conn = dbaccess.Connect(args)
+    cur = conn.cursor()
+    ballots_config = election_meta.BallotsConfig(conn)
+options = [int(o) for d in ballots_config for o in d["options"]]
+names = [n for d in ballots_config for n in d["options"].values()]
+option_district = np.array([i for i, d in enumerate(ballots_config) for o in d["options"]])
+district_ids = [d["district_id"] for d in ballots_config]
+
+with profiling.Stage("load") as stage:
+    histograms = LoadHistograms(options)
+    stage["rows"] = len(options)
+print("Загружены распределения голосов за", len(options), "кандидатов в", len(ballots_config), "округах, точек в распределении:", RESULT_BINS)
+
+# District profiles, each option is compared with the sum of its district
+district_profiles = np.zeros((len(ballots_config), RESULT_BINS), dtype=np.int64)
+np.add.at(district_profiles, option_district, histograms)
+option_profiles = district_profiles[option_district]
+
+# Reference candidates: sum of their normalized deviation profiles is shared by all workers
+reference = None
+in_reference = np.zeros(len(options))
+if args.reference:
+    reference_list = json.load(open(args.reference))["candidates_to_plot"]
+    in_reference = (timebins.SeriesIndex(options, reference_list) >= 0).astype(np.float64)
+    members = np.flatnonzero(in_reference)
+    with profiling.Stage("reference") as stage:
+        z = DeviationZ(histograms[members].astype(np.float64), option_profiles[members].astype(np.float64))[0]
+        reference = (NormalizeRows(z).sum(axis=0), len(members))
+        stage["rows"] = len(members)
+    print("Эталонных кандидатов:", len(members))
+
+# Scan all options by chunks on all cores
+chunks = [(histograms[i:i + ROWS_IN_CHUNK], option_profiles[i:i + ROWS_IN_CHUNK], in_reference[i:i + ROWS_IN_CHUNK])
+          for i in range(0, len(options), ROWS_IN_CHUNK)]
+with profiling.Stage("scan") as stage:
+    if args.jobs > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(args.jobs, len(chunks)), initializer=InitWorker, initargs=(reference,)) as pool:
+            results = pool.map(ScanChunk, chunks)
+    else:
+        InitWorker(reference)
+        results = [ScanChunk(c) for c in chunks]
+    scores = {k: np.concatenate([r[k] for r in results]) for k in results[0]}
+    stage["rows"] = len(options)
+
+# Ranked table, options with few votes are skipped
+def BinTime(b):
+    return timebins.BinToTime(int(b) * BIN_TIME).strftime("%d.%m %H:%M")
+
+columns = [("ID", lambda i: options[i]),
+           ("Кандидат", lambda i: names[i]),
+           ("Округ", lambda i: district_ids[option_district[i]]),
+           ("Голосов", lambda i: int(histograms[i].sum())),
+           ("Откл.,z", lambda i: f"{scores['deviation'][i]:.1f}"),
+           ("Время откл.", lambda i: BinTime(scores["deviation_bin"][i])),
+           ("Хи2/ст.св.", lambda i: f"{scores['chi2'][i]:.2f}"),
+           ("Скачок,z", lambda i: f"{scores['change'][i]:.1f}"),
+           ("Время скачка", lambda i: BinTime(scores["change_bin"][i])),
+           ("Доля до,%", lambda i: f"{scores['share_before'][i]:.1f}"),
+           ("Доля после,%", lambda i: f"{scores['share_after'][i]:.1f}")]
+if reference is not None:
+    columns.append(("Корр.эталон", lambda i: f"{scores['reference'][i]:.2f}"))
+sort_key = {"deviation": scores["deviation"], "change": np.abs(scores["change"]), "reference": scores.get("reference")}[args.sort]
+ranked = [i for i in np.argsort(-sort_key, kind="stable") if histograms[i].sum() >= max(args.min_votes, 1)]
+
+table = [[str(f(i)) for _, f in columns] for i in ranked]
+widths = [max([len(name)] + [len(row[c]) for row in table[:args.top]]) for c, (name, _) in enumerate(columns)]
+print("  ".join(name.rjust(w) for (name, _), w in zip(columns, widths)))
+for row in table[:args.top]:
+    print("  ".join(value.rjust(w) for value, w in zip(row, widths)))
+
+if args.o:
+    with open(args.o, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        writer.writerows(table)
+    print("Таблица сохранена в", args.o)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import io
+import sys
+import gzip
+import json
+import time
+import argparse
+import numpy as np
+from nacl.public import PrivateKey, Box
+from choices_pb2 import Choices
+import timebins
+import dbaccess
+import analysis_db
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Генератор синтетической базы данных ДЭГ для тестов и замеров производительности")
+parser.add_argument("--scale", type=float, help="Масштаб, 1.0 - 10000 зарегистрированных избирателей, по-умолчанию 1.0", default=1.0)
+parser.add_argument("--districts", type=int, help="Число округов, по-умолчанию 15", default=15)
+parser.add_argument("--decrypted", type=float, help="Доля бюллетеней уже расшифрованных в БД, по-умолчанию 0.5", default=0.5)
+parser.add_argument("--seed", type=int, help="Начальное значение генератора случайных чисел, по-умолчанию 1", default=1)
+parser.add_argument("--dump", help="Записать gzip SQL-дамп в указанный файл вместо записи в БД", default=None)
+parser.add_argument("--append-every", type=float, help="Сгенерировать голосование до полудня 18.09 и затем каждые N секунд дописывать в БД следующую минуту голосования (для проверки режима --follow)", default=None)
+dbaccess.AddArguments(parser, "v2021_synth")
+args = parser.parse_args()
+
+VOTERS_PER_SCALE    = 10000
+VOTERS_IN_BLOCK     = 100
+TURNOUT             = 0.85
+VOTE_SHARE          = 0.95
+OPTIONS_IN_DISTRICT = 8
+APPEND_START        = timebins.MskEpoch(18, 12)
+APPEND_STEP         = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    hash text NOT NULL,
+    method_id integer NOT NULL,
+    datetime timestamp with time zone NOT NULL,
+    author text,
+    payload jsonb
+);
+CREATE TABLE IF NOT EXISTS decrypted_ballots (
+    store_tx_hash text NOT NULL,
+    decrypted_choice bigint[],
+    status jsonb
+);
+"""
+
+# Some helper functions
+def CopyEscape(s):
+    return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+def FormatTime(ts):
+    return timebins.EpochToMskTime(ts / 1000).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] + "+03"
+
+def TxHash(rng):
+    return rng.bytes(32).hex()
+
+def TransactionLine(tx_hash, method_id, ts, author, payload):
+    return "\t".join([tx_hash, str(method_id), FormatTime(ts), author if author else "\\N", CopyEscape(json.dumps(payload))]) + "\n"
+
+def DecryptedLine(tx_hash, choice):
+    return f"{tx_hash}\t{{{choice}}}\t\"Synthetic\"\n"
+
+# Vote times follow a daily profile with a night gap, like in the real data
+def RandomTimes(rng, n, start, end):
+    seconds = np.arange(start, end)
+    msk_hour = (seconds + timebins.MSK_OFFSET) // 3600 % 24
+    weights = np.where((msk_hour >= 7) & (msk_hour < 23), 1.0, 0.15)
+    chosen = rng.choice(seconds, size=n, p=weights / weights.sum())
+    return np.sort(chosen * 1000 + rng.integers(0, 1000, size=n))
+
+def EncryptChoice(rng, election_pkey, choice):
+    voter_skey = PrivateKey(rng.bytes(32))
+    prefix = rng.bytes(int(rng.integers(0, 16)))
+    message = len(prefix).to_bytes(2, 'big') + prefix + Choices(data=[choice]).SerializeToString()
+    nonce = rng.bytes(Box.NONCE_SIZE)
+    encrypted = Box(voter_skey, election_pkey).encrypt(message, nonce)
+    return {"public_key": bytes(voter_skey.public_key).hex(), "encrypted_message": encrypted.ciphertext.hex(), "nonce": nonce.hex()}
+
+# Generation of the election: config, private key, registration blocks and voting of every voter
+def GenerateElection(rng, skey):
+    ballots_config = []
+    options_list = []
+    for d in range(args.districts):
+        options = {str(int(o)): f"Кандидат {d+1}-{i+1}" for i,o in enumerate(rng.choice(np.arange(100000000, 250000000), OPTIONS_IN_DISTRICT, replace=False))}
+        ballots_config.append({"district_id": 190 + d, "options": options})
+        options_list.append([int(o) for o in options])
+    yield TransactionLine(TxHash(rng), 0, timebins.EPOCH_MSK_START * 1000 - 3600000, None, {"ballots_config": ballots_config}), None
+    yield TransactionLine(TxHash(rng), 8, timebins.EPOCH_MSK_END * 1000 + 3600000, None, {"private_key": bytes(skey).hex()}), None
+    voting_end = APPEND_START if args.append_every else timebins.EPOCH_MSK_END - 3600
+    voters_number = int(args.scale * VOTERS_PER_SCALE * (voting_end - timebins.EPOCH_MSK_START) / (timebins.EPOCH_MSK_END - 3600 - timebins.EPOCH_MSK_START))
+    yield from GenerateVoters(rng, skey, options_list, voters_number, timebins.EPOCH_MSK_START * 1000 - 86400000, timebins.EPOCH_MSK_START, voting_end)
+
+def GenerateVoters(rng, skey, options_list, voters_number, registration_ts, start, end):
+    voters = [rng.bytes(16).hex() for i in range(voters_number)]
+    for b in range(0, voters_number, VOTERS_IN_BLOCK):
+        yield TransactionLine(TxHash(rng), 1, registration_ts + b, None, {"voters": voters[b:b+VOTERS_IN_BLOCK]}), None
+    times = RandomTimes(rng, voters_number, start, end)
+    for v, t in zip(voters, times):
+        if not rng.random() < TURNOUT:
+            continue
+        voter_key = rng.bytes(32).hex()
+        district_options = options_list[int(rng.integers(0, len(options_list)))]
+        yield TransactionLine(TxHash(rng), 4, int(t), None, {"voter_id": v}), None
+        if rng.random() > VOTE_SHARE:
+            continue
+        check_ts = int(t + rng.integers(5000, 120000))
+        yield TransactionLine(TxHash(rng), 5, check_ts, None, {"voter_key": voter_key}), None
+        choice = int(district_options[min(int(rng.exponential(2)), len(district_options) - 1)])
+        vote_hash = TxHash(rng)
+        vote_ts = check_ts + int(rng.gamma(4, 150))
+        yield TransactionLine(vote_hash, 6, vote_ts, voter_key, {"encrypted_choice": EncryptChoice(rng, skey.public_key, choice)}), \
+            DecryptedLine(vote_hash, choice) if rng.random() < args.decrypted else None
+
+# Writes generated lines as COPY blocks of a plain SQL dump
+def WriteDump(path, lines):
+    transactions, decrypted = io.StringIO(), io.StringIO()
+    for tx_line, decrypted_line in lines:
+        transactions.write(tx_line)
+        if decrypted_line:
+            decrypted.write(decrypted_line)
+    with gzip.open(path, "wt") as f:
+        f.write(SCHEMA)
+        f.write("COPY public.transactions (hash, method_id, datetime, author, payload) FROM stdin;\n")
+        f.write(transactions.getvalue())
+        f.write("\\.\n\n")
+        f.write("COPY public.decrypted_ballots (store_tx_hash, decrypted_choice, status) FROM stdin;\n")
+        f.write(decrypted.getvalue())
+        f.write("\\.\n\n")
+
+def WriteDb(conn, lines):
+    transactions, decrypted = io.StringIO(), io.StringIO()
+    count = 0
+    for tx_line, decrypted_line in lines:
+        transactions.write(tx_line)
+        count += 1
+        if decrypted_line:
+            decrypted.write(decrypted_line)
+    cur = conn.cursor()
+    transactions.seek(0)
+    decrypted.seek(0)
+    cur.copy_expert("COPY transactions (hash, method_id, datetime, author, payload) FROM STDIN", transactions)
+    cur.copy_expert("COPY decrypted_ballots (store_tx_hash, decrypted_choice, status) FROM STDIN", decrypted)
+    conn.commit()
+    return count
+
+rng = np.random.default_rng(args.seed)
+skey = PrivateKey(rng.bytes(32))
+
+if args.dump:
+    WriteDump(args.dump, GenerateElection(rng, skey))
+    print("Дамп сохранён в", args.dump)
+    sys.exit(0)
+
+conn = dbaccess.Connect(args)
+cur = conn.cursor()
+cur.execute(SCHEMA)
+cur.execute("TRUNCATE transactions, decrypted_ballots")
+# Derived data of the previous generation: analysis tables are refreshed only by newer transactions
+cur.execute("DROP TABLE IF EXISTS decrypt_checkpoint")
+analysis_db.Drop(cur)
+conn.commit()
+print("Записано транзакций:", WriteDb(conn, GenerateElection(rng, skey)))
+
+# Keep appending next minutes of voting to emulate a growing observer DB
+if args.append_every:
+    cur.execute("select payload->'ballots_config' from transactions where method_id=0")
+    options_list = [[int(o) for o in d["options"]] for d in cur.fetchone()[0]]
+    voters_number = max(1, int(args.scale * VOTERS_PER_SCALE * APPEND_STEP / (timebins.EPOCH_MSK_END - 3600 - timebins.EPOCH_MSK_START)))
+    clock = APPEND_START
+    while clock < timebins.EPOCH_MSK_END - 3600:
+        time.sleep(args.append_every)
+        count = WriteDb(conn, GenerateVoters(rng, skey, options_list, voters_number, clock * 1000, clock, clock + APPEND_STEP))
+        clock += APPEND_STEP
+        print("Дописано транзакций:", count, "время голосования:", timebins.EpochToMskTime(clock).strftime("%d.%m %H:%M"))
@@ -1,130 +1,306 @@
 #!/usr/bin/env python3
 
 import sys
-import psycopg2
-import psycopg2.extras
+import os
+import csv
 import json
-import time
-import pytz
 import itertools
 import argparse
-from datetime import datetime
-from matplotlib import pyplot as plt
+import multiprocessing
+import numpy as np
+import analysis_cache
+import analysis_db
+import dbaccess
+import election_meta
+import timebins
+import profiling
+import confidence
+import sampling
+import vote_pyramid
 
 # Parse command line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("-l", action="store", help="Номер округа для которого необходимо вывести ID кандидатов вместо построениея графика, 0 - все округа, по-умолчанию не выводить", default=-1)
 parser.add_argument("-c", action="store", help="Путь до JSON файла с параметрами графика для построения", default="plot_config.json")
-parser.add_argument("--dbaddr", help="Хост базы данных, по-умолчанию localhost", default="localhost")
-parser.add_argument("--dbname", help="Название базы данных, по-умолчанию v2021_om", default="v2021_om")
-parser.add_argument("--dbuser", help="Пользователь базы данных, по-умолчанию postgres", default="postgres")
-parser.add_argument("--dbpass", help="Пароль базы данных, по-умолчанию mypsqlpassword", default="mypsqlpassword")
+parser.add_argument("--batch", nargs="+", help="Построить без вывода на экран графики для всех перечисленных JSON файлов и каталогов с ними", default=None)
+parser.add_argument("-o", action="store", help="Каталог для сохранения графиков в пакетном режиме, по-умолчанию images", default="images")
+parser.add_argument("--format", help="Формат файлов графиков в пакетном режиме (png, svg...), по-умолчанию png", default="png")
+parser.add_argument("--jobs", type=int, help="Число процессов отрисовки в пакетном режиме, по-умолчанию число ядер", default=os.cpu_count())
+parser.add_argument("--follow", type=float, help="Следить за поступлением новых голосов и обновлять график каждые FOLLOW секунд", default=None)
+parser.add_argument("--cache", help="Каталог локального кэша данных (см. extract_cache.py), по-умолчанию используется БД", default=None)
+parser.add_argument("--bands", type=int, help="Для графиков в процентах построить 95%% доверительные интервалы по BANDS повторным выборкам (например 1000), по-умолчанию не строить", default=0)
+parser.add_argument("--csv", help="Каталог для сохранения кривых (и доверительных интервалов) в CSV файлы с именами JSON файлов графиков", default=None)
+dbaccess.AddArguments(parser)
+profiling.AddArguments(parser)
+sampling.AddArguments(parser)
 args = parser.parse_args()
+profiling.Start(args)
+if (args.follow or args.sample) and args.cache:
+    print("Режимы слежения и выборки работают только с базой данных")
+    sys.exit(1)
+if args.follow and args.sample:
+    print("Режим слежения не работает с выборкой")
+    sys.exit(1)
+if args.sample:
+    print(sampling.Describe(args.sample))
+
+# Load vote config from local cache or from metadata of the database (cached on disk)
+if args.cache:
+    ballots_config = analysis_cache.LoadMeta(args.cache)["ballots_config"]
+else:
+    conn = dbaccess.Connect(args)
+    cur = conn.cursor()
+    ballots_config = election_meta.BallotsConfig(conn)
+vote_options = election_meta.VoteOptions(ballots_config)
 
-# Connect to database
-conn = psycopg2.connect(
-    host=args.dbaddr,
-    user=args.dbuser,
-    password=args.dbpass,
-    database=args.dbname)
-
-cur = conn.cursor(cursor_factory = psycopg2.extras.DictCursor)
-cur2 = conn.cursor(cursor_factory = psycopg2.extras.DictCursor)
-
-# Load vote config from "create vote" transaction
-cur.execute("select payload from transactions where method_id=0")
-ballots_config = cur.fetchone()[0]["ballots_config"]
-vote_options = {}
-for d in ballots_config:
-    vote_options.update(d["options"])
-    
-# If list command was issued - process it and exit
+# If list command was issued - process it and exit before plotting modules are imported
 list_arg = int(args.l)
 if list_arg >= 0:
-    for d in ballots_config:
-        if (list_arg == 0) or (d["district_id"] == list_arg):
-            for o in d["options"]:
-                print(o, ":", d["options"][o])
+    election_meta.PrintOptions(ballots_config, list_arg)
     sys.exit(0)
 
-# Load plot configuration from JSON   
-plot_config = json.load(open(args.c))
+if args.cache:
+    # Vote pyramid of the cache gives histograms without reading all votes
+    pyramid = vote_pyramid.Load(args.cache) if vote_pyramid.Exists(args.cache) else None
+else:
+    # Compact tables of build_analysis_db.py are used if present, follow mode reads new transactions directly
+    use_analysis_db = not args.follow and analysis_db.Use(cur)
 
-# Some helper constants, all times are in seconds
-def TimeToSecs(t):
-    return int(time.mktime(t.timetuple()))
-MSK_TZ              = pytz.timezone("Europe/Moscow")
-MSK_START_TIME      = datetime(2021, 9, 17, 8, 0, 0)
-UNIXTIME_MSK_START  = TimeToSecs(datetime(2021, 9, 17, 8, 0, 0, tzinfo=MSK_TZ))
-UNIXTIME_MSK_END    = TimeToSecs(datetime(2021, 9, 19, 21, 0, 0, tzinfo=MSK_TZ))
-BIN_TIME            = plot_config["minutes_in_bin"] * 60 
-RESULT_BINS         = (UNIXTIME_MSK_END-UNIXTIME_MSK_START) // BIN_TIME
-GRAPH_TICK_TIME     = plot_config["minutes_per_axis_tick"] * 60
-
-# Some helper functions
-def TimeToSecondsFromStart(t):
-    unixtime_msk = TimeToSecs(t)
-    return unixtime_msk - UNIXTIME_MSK_START
-
-def TimeToBin(t):
-    mt = t.astimezone(MSK_TZ)   # to correct if DB has non MSK time
-    return TimeToSecondsFromStart(mt) // BIN_TIME
-
-def BinToTime(b):
-    return datetime.fromtimestamp(b + UNIXTIME_MSK_START)
-
-def GenerateTicks():
-    x = range(0, RESULT_BINS, GRAPH_TICK_TIME // BIN_TIME)
-    labels = []
-    for i in x:
-        labels.append(BinToTime(i * BIN_TIME).strftime('%d.%m %H:%M'))
-    return [x,labels]
-
-# Prepare data structures for plot
-candidate_list = plot_config["candidates_to_plot"]
-binned_results = [[0 for i in range(RESULT_BINS)] for j in range(len(candidate_list))]
-legend_names = []
-
-# Perform database searches for all candidates
-for i,candidate in enumerate(candidate_list):
-    candidate_name = vote_options[str(candidate)]
-    print(i, ": обрабатываем голоса за кандидата", candidate_name)
-    legend_names.append(candidate_name)
-    
-    cur.execute("select store_tx_hash from decrypted_ballots where decrypted_choice[1]='" + str(candidate) + "'")
-    for row in cur:
-        hash = row[0]
-        cur2.execute("select datetime from transactions where hash=\'"+str(hash)+"\' limit 1")
-        vote_time=cur2.fetchone()[0]
-        bin_num = TimeToBin(vote_time)
-        binned_results[i][bin_num] += 1
-
-# Integrate if required
-if plot_config["integrate"]:
-    for b in range(1, RESULT_BINS):
-        for i in range(len(candidate_list)):
-            binned_results[i][b] += binned_results[i][b-1]
-    for i in range(len(candidate_list)):
-        print("Всего голосов за", vote_options[str(candidate_list[i])], ":", binned_results[i][-1])
-        
-# Calculate percentage if required
-if plot_config["percentage"]:
-    for b in range(RESULT_BINS):
-        total_votes_in_bin = 0
-        for i in range(len(candidate_list)):
-            total_votes_in_bin += binned_results[i][b]
-        if (total_votes_in_bin != 0):
-            for i in range(len(candidate_list)):
-                binned_results[i][b] /= (total_votes_in_bin / 100)
+# Batch mode renders to files only
+import matplotlib
+if args.batch:
+    matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+
+# Some helper functions, all times are in seconds
+def LoadPlotConfigs(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".json")))
+        else:
+            files.append(path)
+    configs = [(f, json.load(open(f))) for f in files]
+    return [(f, c) for f, c in configs if isinstance(c, dict) and "candidates_to_plot" in c]
+
+def CountVotesInDb(candidate_list, bin_time, start, end):
+    result_bins = (end - start) // bin_time
+    if use_analysis_db:
+        query = """select choice, ((ts / 1000 - %(start)s) / %(bin_time)s)::int as bin, count(*)
+                   from analysis.votes
+                   where choice = any(%(candidates)s) and ts >= %(start)s * 1000 and ts < %(end)s * 1000
+                     and {sample}
+                   group by 1, 2""".format(sample=sampling.Condition("hash", dbaccess.BYTEA, args.sample))
+    else:
+        query = """select d.decrypted_choice[1], floor((extract(epoch from t.datetime) - %(start)s) / %(bin_time)s)::int as bin, count(*)
+                   from decrypted_ballots d join transactions t on t.hash = d.store_tx_hash
+                   where d.decrypted_choice[1] = any(%(candidates)s) and t.method_id = 6
+                     and t.datetime >= to_timestamp(%(start)s) and t.datetime < to_timestamp(%(end)s) and {sample}
+                   group by 1, 2""".format(sample=sampling.Condition("t.hash", dbaccess.HEX, args.sample))
+    cur.execute(query, {"start": timebins.EPOCH_MSK_START + start, "end": timebins.EPOCH_MSK_START + end,
+                        "bin_time": bin_time, "candidates": candidate_list})
+    rows = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 3)
+    binned_results = np.zeros((len(candidate_list), result_bins), dtype=np.int64)
+    np.add.at(binned_results, (timebins.SeriesIndex(rows[:, 0], candidate_list), rows[:, 1]), rows[:, 2])
+    return binned_results
+
+def BinTime(plot_config):
+    return plot_config["seconds_in_bin"] if "seconds_in_bin" in plot_config else plot_config["minutes_in_bin"] * 60
+
+# Plotted interval in seconds from the start of voting: "time_range" of the plot config or the whole voting, in whole bins
+def TimeRange(plot_config):
+    bin_time = BinTime(plot_config)
+    period = timebins.ResultBins(bin_time) * bin_time
+    if "time_range" not in plot_config:
+        return 0, period
+    start, end = (min(max(timebins.ParseMskTime(t) - timebins.EPOCH_MSK_START, 0), period) for t in plot_config["time_range"])
+    return start, start + max(end - start, 0) // bin_time * bin_time
+
+# Votes (choice, time) of the candidates, for batch processing of many plots
+def LoadVotes(candidate_list):
+    if args.cache and pyramid is not None:
+        return None
+    if args.cache:
+        votes = analysis_cache.LoadTable(args.cache, "votes")
+        return votes["choice"], votes["ts"]
+    if use_analysis_db:
+        return dbaccess.FetchArrays(conn, f"select choice, ts from analysis.votes where choice = any(%s) and {sampling.Condition('hash', dbaccess.BYTEA, args.sample)}",
+                                    [np.int64, np.int64], (candidate_list,))
+    return dbaccess.FetchArrays(conn, f"""select d.decrypted_choice[1], {timebins.SqlEpochMs("t.datetime")}
+                                          from decrypted_ballots d join transactions t on t.hash = d.store_tx_hash
+                                          where d.decrypted_choice[1] = any(%s) and t.method_id = 6
+                                            and {sampling.Condition("t.hash", dbaccess.HEX, args.sample)}""",
+                                [np.int64, np.int64], (candidate_list,))
+
+def CountVotes(votes, candidate_list, bin_time, start, end):
+    if votes is None:
+        return vote_pyramid.Counts(pyramid, candidate_list, bin_time, start, end)
+    choice, ts = votes
+    # Bins are counted from the start of the interval
+    counts = timebins.SeriesBinCounts(np.asarray(ts) - start * 1000, timebins.SeriesIndex(choice, candidate_list), len(candidate_list), bin_time)
+    return counts[:, :(end - start) // bin_time]
+
+# Integrate and calculate percentage if required, percentage curves get confidence bands if requested.
+# Counts of a sample are scaled to all data, curves of a sample always get bands of sampling error.
+def PostProcess(plot_config, binned_results):
+    bands = None
+    if plot_config["integrate"]:
+        binned_results = timebins.Integrate(binned_results)
+        for i,c in enumerate(plot_config["candidates_to_plot"]):
+            print("Всего голосов за", vote_options[str(c)], ":", sampling.Estimate(binned_results[i][-1], args.sample))
+    if plot_config["percentage"]:
+        if args.bands or args.sample:
+            bands = confidence.ShareBands(binned_results, binned_results.sum(axis=0), args.bands or confidence.RESAMPLES)
+        binned_results = timebins.Percentage(binned_results)
+    elif args.sample:
+        binned_results, error = sampling.ScaleCounts(binned_results, args.sample)
+        bands = (binned_results - 2 * error, binned_results + 2 * error)
+    return binned_results, bands
+
+# Curves with bands as CSV table, one row per time bin
+def ExportCsv(path, plot_config, binned_results, bands):
+    bin_time = BinTime(plot_config)
+    start, end = TimeRange(plot_config)
+    names = [vote_options[str(c)] for c in plot_config["candidates_to_plot"]]
+    columns = list(binned_results)
+    if bands is not None:
+        names += [n + suffix for suffix in (" (нижняя граница)", " (верхняя граница)") for n in names]
+        columns += list(bands[0]) + list(bands[1])
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Время"] + names)
+        for b in range(len(columns[0])):
+            writer.writerow([timebins.BinToTime(start + b * bin_time).strftime("%d.%m %H:%M:%S")] + [f"{c[b]:g}" for c in columns])
+    print("Сохранены кривые", path)
 
 # Build pretty plot
-markers = itertools.cycle(['o', 's', 'v', '^', 'p', '*'])
-for res in binned_results:
-    plt.plot(res, marker=next(markers))
-ticks = GenerateTicks()
-plt.xticks(ticks[0], ticks[1], rotation=90)
-plt.grid()
-plt.legend(legend_names)
-    
-# Show window with plot    
+def DrawPlot(plot_config, binned_results, bands = None):
+    bin_time = BinTime(plot_config)
+    markers = itertools.cycle(['o', 's', 'v', '^', 'p', '*'])
+    lines = []
+    for i,res in enumerate(binned_results):
+        lines += plt.plot(res, marker=next(markers))
+        if bands is not None:
+            plt.fill_between(range(len(res)), bands[0][i], bands[1][i], color=lines[-1].get_color(), alpha=0.2, linewidth=0)
+    ticks = timebins.GenerateTicks(bin_time, plot_config["minutes_per_axis_tick"] * 60, *TimeRange(plot_config))
+    plt.xticks(ticks[0], ticks[1], rotation=90)
+    plt.grid()
+    plt.legend(lines, [vote_options[str(c)] for c in plot_config["candidates_to_plot"]])
+
+def RenderPlot(job):
+    plot_config, binned_results, bands, path = job
+    plt.figure(figsize=(16, 9))
+    DrawPlot(plot_config, binned_results, bands)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+    return path
+
+# Batch mode: votes are loaded once for all plots, plots are rendered by a pool of processes
+if args.batch:
+    plot_configs = LoadPlotConfigs(args.batch)
+    all_candidates = sorted(set(c for f, pc in plot_configs for c in pc["candidates_to_plot"]))
+    print("Загрузка голосов за", len(all_candidates), "кандидатов для", len(plot_configs), "графиков")
+    with profiling.Stage("load") as stage:
+        votes = LoadVotes(all_candidates)
+        stage["rows"] = len(votes[0]) if votes is not None else 0
+    os.makedirs(args.o, exist_ok=True)
+    if args.csv:
+        os.makedirs(args.csv, exist_ok=True)
+    jobs = []
+    for f, pc in plot_configs:
+        with profiling.Stage("count") as stage:
+            counts = CountVotes(votes, pc["candidates_to_plot"], BinTime(pc), *TimeRange(pc))
+            stage["rows"] = int(counts.sum()) if votes is None else len(votes[0])
+        with profiling.Stage("postprocess") as stage:
+            binned_results, bands = PostProcess(pc, counts)
+            stage["rows"] = counts.size
+        name = os.path.splitext(os.path.basename(f))[0]
+        if args.csv:
+            ExportCsv(os.path.join(args.csv, name + ".csv"), pc, binned_results, bands)
+        jobs.append((pc, binned_results, bands, os.path.join(args.o, name + "." + args.format)))
+    with profiling.Stage("render") as stage, multiprocessing.Pool(max(1, args.jobs)) as pool:
+        for path in pool.imap_unordered(RenderPlot, jobs):
+            print("Сохранён график", path)
+            stage["rows"] += 1
+    sys.exit(0)
+
+# Load plot configuration from JSON
+plot_config = json.load(open(args.c))
+candidate_list = plot_config["candidates_to_plot"]
+
+# Follow mode: only votes newer than high-water mark are fetched, decrypted if required and added to bins
+if args.follow:
+    # Decryption modules are needed only to decrypt new votes
+    import ballot_crypto
+    from nacl.public import PrivateKey
+
+    # Key is loaded on the first vote without stored decryption. Metadata loading commits,
+    # so it uses a connection of its own and does not close the poll cursor.
+    def LoadKey():
+        key_conn = dbaccess.Connect(args)
+        try:
+            return PrivateKey(bytes.fromhex(election_meta.PrivateKey(key_conn)))
+        except ValueError:
+            return None
+        finally:
+            key_conn.close()
+
+    skey = None
+    bin_time = BinTime(plot_config)
+    start, end = TimeRange(plot_config)
+    binned_results = np.zeros((len(candidate_list), (end - start) // bin_time), dtype=np.int64)
+    watermark = dbaccess.NewWatermark()
+    total_votes = 0
+    total_undecrypted = 0
+    while True:
+        new_votes = 0
+        new_undecrypted = 0
+        key_checked = False
+        with profiling.Stage("poll") as stage:
+            for rows in dbaccess.PollNewRows(conn, 6, f"""d.decrypted_choice[1], {ballot_crypto.ENCRYPTED_CHOICE_COLUMNS}""", watermark,
+                                             "left join decrypted_ballots d on d.store_tx_hash = t.hash"):
+                undecrypted = sum(r[2] is None for r in rows)
+                if undecrypted and skey is None and not key_checked:
+                    skey = LoadKey()
+                    key_checked = True
+                if skey is not None:
+                    choice = [r[2] if r[2] is not None else ballot_crypto.DecryptBallot(skey, *r[3:]) for r in rows]
+                else:
+                    # Until the key is published only votes decrypted in the DB are counted
+                    choice = [r[2] if r[2] is not None else analysis_cache.NO_CHOICE for r in rows]
+                    new_undecrypted += undecrypted
+                ts = [r[1] for r in rows]
+                binned_results += CountVotes((np.array(choice, dtype=np.int64), np.array(ts, dtype=np.int64)), candidate_list, bin_time, start, end)
+                new_votes += len(rows)
+            stage["rows"] = new_votes
+        if new_votes:
+            total_votes += new_votes
+            total_undecrypted += new_undecrypted
+            print("Новых голосов:", new_votes, "всего:", total_votes)
+            if new_undecrypted:
+                print("Ключ расшифровки ещё не опубликован в БД, учтены только расшифрованные в БД голоса, не учтено голосов:", total_undecrypted)
+            with profiling.Stage("draw"):
+                plt.clf()
+                DrawPlot(plot_config, *PostProcess(plot_config, binned_results))
+        plt.pause(args.follow)
+
+# Count votes for all candidates per time bin
+print("Подсчёт голосов за", len(candidate_list), "кандидатов")
+with profiling.Stage("count") as stage:
+    if args.cache:
+        binned_results = CountVotes(LoadVotes(candidate_list), candidate_list, BinTime(plot_config), *TimeRange(plot_config))
+    else:
+        binned_results = CountVotesInDb(candidate_list, BinTime(plot_config), *TimeRange(plot_config))
+    stage["rows"] = int(binned_results.sum())
+with profiling.Stage("postprocess") as stage:
+    stage["rows"] = binned_results.size
+    binned_results, bands = PostProcess(plot_config, binned_results)
+if args.csv:
+    os.makedirs(args.csv, exist_ok=True)
+    ExportCsv(os.path.join(args.csv, os.path.splitext(os.path.basename(args.c))[0] + ".csv"), plot_config, binned_results, bands)
+with profiling.Stage("draw"):
+    DrawPlot(plot_config, binned_results, bands)
+
+# Show window with plot
 plt.show()
@@ -0,0 +1,95 @@
+# Shared time binning of the plot scripts.
+#
+# All timestamps are int64 epoch milliseconds (as in analysis_cache), bins are
+# counted in seconds from the start of voting. Moscow time is a fixed UTC+3,
+# so results do not depend on the timezone of the machine.
+
+import calendar
+import numpy as np
+from datetime import datetime, timedelta, timezone
+
+MSK_OFFSET          = 3 * 3600
+MSK_TZ              = timezone(timedelta(seconds=MSK_OFFSET))
+
+def MskEpoch(d, h, m = 0, s = 0):
+    return calendar.timegm((2021, 9, d, h, m, s)) - MSK_OFFSET
+
+EPOCH_MSK_START     = MskEpoch(17, 8)
+EPOCH_MSK_END       = MskEpoch(19, 21)
+
+# SQL expression converting datetime column to epoch milliseconds
+def SqlEpochMs(column = "datetime"):
+    return f"floor(extract(epoch from {column}) * 1000)::bigint"
+
+# "dd.mm HH:MM" in Moscow time (as on plot axes) to epoch seconds
+def ParseMskTime(text):
+    t = datetime.strptime(text, "%d.%m %H:%M")
+    return MskEpoch(t.day, t.hour, t.minute)
+
+def ResultBins(bin_time):
+    return (EPOCH_MSK_END - EPOCH_MSK_START) // bin_time
+
+def EpochMsToBin(ts, bin_time):
+    return (np.asarray(ts, dtype=np.int64) // 1000 - EPOCH_MSK_START) // bin_time
+
+def EpochToMskTime(t):
+    return datetime.fromtimestamp(t, MSK_TZ)
+
+def BinToTime(b):
+    return EpochToMskTime(b + EPOCH_MSK_START)
+
+# Epoch milliseconds to numpy datetimes in Moscow wall clock time, for plot axes
+def EpochMsToMskDatetime(ts):
+    return (np.asarray(ts, dtype=np.int64) + MSK_OFFSET * 1000).astype("datetime64[ms]")
+
+# Ticks every tick_time seconds of voting, positions are in bins from start (seconds from the start of voting)
+def GenerateTicks(bin_time, tick_time, start = 0, end = None):
+    end = ResultBins(bin_time) * bin_time if end is None else end
+    times = range(-(-start // tick_time) * tick_time, end, tick_time)
+    x = [(t - start) / bin_time for t in times]
+    labels = [BinToTime(t).strftime('%d.%m %H:%M') for t in times]
+    return [x,labels]
+
+# Histogram of timestamps, times outside of voting period are dropped
+def BinCounts(ts, bin_time):
+    bins = EpochMsToBin(ts, bin_time)
+    result_bins = ResultBins(bin_time)
+    return np.bincount(bins[(bins >= 0) & (bins < result_bins)], minlength=result_bins)
+
+# Index of every value in series list, -1 for values not in the list
+def SeriesIndex(values, series):
+    values = np.asarray(values)
+    series = np.asarray(series)
+    if len(series) == 0:
+        return np.full(len(values), -1)
+    order = np.argsort(series)
+    idx = order[np.minimum(np.searchsorted(series[order], values), len(series) - 1)]
+    return np.where(series[idx] == values, idx, -1)
+
+# Histograms of timestamps for several series at once, series[i] is series index of ts[i] (-1 to skip)
+def SeriesBinCounts(ts, series, series_number, bin_time):
+    bins = EpochMsToBin(ts, bin_time)
+    result_bins = ResultBins(bin_time)
+    series = np.asarray(series)
+    mask = (bins >= 0) & (bins < result_bins) & (series >= 0)
+    counts = np.bincount(series[mask] * result_bins + bins[mask], minlength=series_number * result_bins)
+    return counts.reshape(series_number, result_bins)
+
+# Latency in milliseconds to histogram bin, latencies out of range go to the first or last bin
+def LatencyToBin(diff_ms, msecs_in_bin, bins):
+    return np.clip(np.asarray(diff_ms, dtype=np.int64) // msecs_in_bin, 0, bins - 1)
+
+def Integrate(binned):
+    return np.cumsum(binned, axis=-1)
+
+# Share of every series in percent of all series in the same bin, empty bins stay zero
+def Percentage(binned):
+    binned = np.asarray(binned, dtype=np.float64)
+    totals = binned.sum(axis=0)
+    return np.divide(binned * 100, totals, out=np.zeros_like(binned), where=totals != 0)
+
+# Normalize histogram to percent of its total
+def Normalize(binned):
+    binned = np.asarray(binned, dtype=np.float64)
+    total = binned.sum()
+    return binned * 100 / total if total else binned
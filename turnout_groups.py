@@ -0,0 +1,24 @@
+# Turnout groups of registration blocks (turnout_plot.py, dashboard.py).
+#
+# Turnout of a block is the percent of its registered voters with an issued
+# ballot. Blocks are split into low (< LOW_TURNOUT_VAL), high (> HIGH_TURNOUT_VAL)
+# and normal turnout groups. Blocks without registered voters (out of the
+# sample) have nan turnout and do not get into any group.
+
+import numpy as np
+
+LOW_TURNOUT_VAL     = 90
+HIGH_TURNOUT_VAL    = 99
+
+# Turnout of every block in percent from numbers of issued ballots and registered voters of blocks
+def BlockPercent(issued, registered):
+    registered = np.asarray(registered)
+    return np.divide(np.asarray(issued) * 100.0, registered, out=np.full(len(registered), np.nan), where=registered != 0)
+
+# Masks of low, high and normal turnout for an array of turnouts (of blocks or of voters' blocks)
+def Masks(turnout, low = LOW_TURNOUT_VAL, high = HIGH_TURNOUT_VAL):
+    return turnout < low, turnout > high, (turnout >= low) & (turnout <= high)
+
+# Histograms of issue times by turnout group, block_bins is blocks x time bins
+def Histograms(block_bins, block_turnout, low = LOW_TURNOUT_VAL, high = HIGH_TURNOUT_VAL):
+    return tuple(block_bins[mask].sum(axis=0) for mask in Masks(block_turnout, low, high))
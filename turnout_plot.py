@@ -1,157 +1,259 @@
 #!/usr/bin/env python3
 
 import sys
-import psycopg2
-import psycopg2.extras
 import json
-import time
-import pytz
 import itertools
 import argparse
-from datetime import datetime
+import numpy as np
+import analysis_cache
+import analysis_db
+import dbaccess
+import timebins
+import profiling
+import confidence
+import sampling
+import turnout_groups
 from matplotlib import pyplot as plt
+from matplotlib import colors, dates
 
 # Parse command line arguments
 parser = argparse.ArgumentParser()
-parser.add_argument("--dbaddr", help="Хост базы данных, по-умолчанию localhost", default="localhost")
-parser.add_argument("--dbname", help="Название базы данных, по-умолчанию v2021_om", default="v2021_om")
-parser.add_argument("--dbuser", help="Пользователь базы данных, по-умолчанию postgres", default="postgres")
-parser.add_argument("--dbpass", help="Пароль базы данных, по-умолчанию mypsqlpassword", default="mypsqlpassword")
+parser.add_argument("--follow", type=float, help="Следить за поступлением новых транзакций и обновлять графики каждые FOLLOW секунд", default=None)
+parser.add_argument("--density-scale", choices=["log", "linear"], help="Шкала цвета карты плотности выдачи бюллетеней по блокам, по-умолчанию log", default="log")
+parser.add_argument("--cache", help="Каталог локального кэша данных (см. extract_cache.py), по-умолчанию используется БД", default=None)
+dbaccess.AddArguments(parser)
+profiling.AddArguments(parser)
+sampling.AddArguments(parser)
 args = parser.parse_args()
+profiling.Start(args)
+if (args.follow or args.sample) and args.cache:
+    print("Режимы слежения и выборки работают только с базой данных")
+    sys.exit(1)
+if args.follow and args.sample:
+    print("Режим слежения не работает с выборкой")
+    sys.exit(1)
+if args.sample:
+    # Whole registration blocks are sampled, so turnout of sampled blocks is exact
+    print(sampling.Describe(args.sample))
 
-# Connect to database
-conn = psycopg2.connect(
-    host=args.dbaddr,
-    user=args.dbuser,
-    password=args.dbpass,
-    database=args.dbname)
-
-cur = conn.cursor(cursor_factory = psycopg2.extras.DictCursor)
+# Connect to database if local cache is not used
+if not args.cache:
+    conn = dbaccess.Connect(args)
+    cur = conn.cursor()
+    # Compact tables of build_analysis_db.py are used if present, follow mode reads new transactions directly
+    use_analysis_db = not args.follow and analysis_db.Use(cur)
 
 # Some helper constants, all times are in seconds
-def TimeToSecs(t):
-    return int(time.mktime(t.timetuple()))
-MSK_TZ              = pytz.timezone("Europe/Moscow")
-MSK_START_TIME      = datetime(2021, 9, 17, 8, 0, 0)
-UNIXTIME_MSK_START  = TimeToSecs(datetime(2021, 9, 17, 8, 0, 0, tzinfo=MSK_TZ))
-UNIXTIME_MSK_END    = TimeToSecs(datetime(2021, 9, 19, 21, 0, 0, tzinfo=MSK_TZ))
-BIN_TIME            = 30*60 
-RESULT_BINS         = (UNIXTIME_MSK_END-UNIXTIME_MSK_START) // BIN_TIME
+BIN_TIME            = 30*60
+RESULT_BINS         = timebins.ResultBins(BIN_TIME)
+PERIOD              = timebins.EPOCH_MSK_END - timebins.EPOCH_MSK_START
 GRAPH_TICK_TIME     = 3600 * 2
-PREREVOTE_TIME      = datetime(2021, 9, 17, 9, 0, 0, tzinfo=MSK_TZ)
-LOW_TURNOUT_VAL     = 90
-HIGH_TURNOUT_VAL    = 99
+PREREVOTE_TIME      = timebins.MskEpoch(17, 9)
+LOW_TURNOUT_VAL     = turnout_groups.LOW_TURNOUT_VAL
+HIGH_TURNOUT_VAL    = turnout_groups.HIGH_TURNOUT_VAL
+DENSITY_COLUMNS     = 1000
+DENSITY_ROWS        = 600
+DENSITY_CHUNK       = 1 << 20
+FOLLOW_BLOCKS_IN_COLUMN = 16
 
 # Some helper functions
-def TimeToSecondsFromStart(t):
-    unixtime_msk = TimeToSecs(t)
-    return unixtime_msk - UNIXTIME_MSK_START
-
-def TimeToBin(t):
-    mt = t.astimezone(MSK_TZ)   # to correct if DB has non MSK time
-    return TimeToSecondsFromStart(mt) // BIN_TIME
-
-def BinToTime(b):
-    return datetime.fromtimestamp(b + UNIXTIME_MSK_START)
-    
-def GenerateTicks():
-    x = range(0, RESULT_BINS, GRAPH_TICK_TIME // BIN_TIME)
-    labels = []
-    for i in x:
-        labels.append(BinToTime(i * BIN_TIME).strftime('%d.%m %H:%M'))
-    return [x,labels]
-
-# Cache all issued ballots in set
-prerevote_issued = 0
-prerevote_voted = 0
-cur.execute("select payload->'voter_id' from transactions where method_id=4")
-voter_ids_with_ballots = [r[0] for r in cur.fetchall()]
-cur.execute("select datetime from transactions where method_id=4")
-ballot_times_list = [r['datetime'] for r in cur.fetchall()]
-for t in ballot_times_list:
-    if t < PREREVOTE_TIME:
-        prerevote_issued += 1
-ballots_times = dict(zip(voter_ids_with_ballots, ballot_times_list))
-voter_ids_with_ballots_set = set(voter_ids_with_ballots)
-
-# Perform database searches for all registrations
-cur.execute("select payload from transactions where method_id=1")
-
-total_blocks = cur.rowcount
-turnout = [0] * total_blocks
-forplot_x = []
-forplot_y = []
-low_turnout_bins = [0] * RESULT_BINS
-high_turnout_bins = [0] * RESULT_BINS
-norm_turnout_bins = [0] * RESULT_BINS
-votes_time = [0] * RESULT_BINS
-
-for i,row in enumerate(cur):
-    voters = row[0]["voters"]
-    voters_voted = []
-    for v in voters:
-        if v in voter_ids_with_ballots_set:
-            voters_voted.append(v)
-            turnout[i] += 1
-            forplot_x.append(i)
-            forplot_y.append(ballots_times[v])
-    for v in voters_voted:
-        if turnout[i] < LOW_TURNOUT_VAL:
-            low_turnout_bins[TimeToBin(ballots_times[v])] += 1
-        elif (turnout[i] >HIGH_TURNOUT_VAL):
-            high_turnout_bins[TimeToBin(ballots_times[v])] += 1
-        else:
-            norm_turnout_bins[TimeToBin(ballots_times[v])] += 1
-
-# Perform database searches for all votes
-cur.execute("select datetime from transactions where method_id=6")
-for i,row in enumerate(cur):
-    votes_time[TimeToBin(row[0])] += 1
-    if row[0] < PREREVOTE_TIME:
-        prerevote_voted += 1
-
-print("Время до возможности переголосования:", PREREVOTE_TIME.strftime('%d.%m %H:%M'), "Выдано бюллетеней:", prerevote_issued, "Голосов:", prerevote_voted)    
-
-# Normalize
-low_sum = sum(low_turnout_bins)
-high_sum = sum(high_turnout_bins)
-norm_sum = sum(norm_turnout_bins)
-vote_sum = sum(votes_time)
-for i in range(RESULT_BINS):
-    low_turnout_bins[i] *=  100 / low_sum
-    high_turnout_bins[i] *= 100 / high_sum
-    norm_turnout_bins[i] *= 100 / norm_sum
-    votes_time[i] *= 100 / vote_sum
-
-# Build several plots
-axs = [plt.subplot2grid((2, 2), (1, 0), colspan=2),plt.subplot2grid((2, 2),(0, 0)), plt.subplot2grid((2, 2),(0, 1))]
-
-# Create issue ballots & vote times plot
-markers = itertools.cycle(['o', 's', 'v', '^', 'p', '*'])
-axs[0].plot(low_turnout_bins, marker=next(markers))
-axs[0].plot(high_turnout_bins, marker=next(markers))
-axs[0].plot(norm_turnout_bins, marker=next(markers))
-axs[0].plot(votes_time, marker=next(markers))
-ticks = GenerateTicks()
-axs[0].set_xticks(ticks[0])
-axs[0].set_xticklabels(ticks[1], rotation=90)
-axs[0].grid()
-axs[0].legend(["Динамика выдачи бюллетеней избирателям из блоков с явкой < "+str(LOW_TURNOUT_VAL)+"% (в % от полного числа таковых)", \
-    "Динамика выдачи бюллетеней избирателям из блоков с явкой > "+str(HIGH_TURNOUT_VAL)+"% (в % от полного числа таковых)", \
-    "Динамика выдачи бюллетеней избирателям из блоков с явкой "+str(LOW_TURNOUT_VAL)+"-"+str(HIGH_TURNOUT_VAL)+"% (в % от полного числа таковых)", \
-    "Динамика голосования  (в % от полного числа голосов)"])
-
-# Create 
-axs[1].plot(turnout)
-axs[1].grid()
-axs[1].legend(["Процент проголосовавших в блоке"])
-axs[1].set_xlabel("Последовательный номер блока (транзакции) регистрации избирателя")
-
-# Create issue ballot time scatter plot
-axs[2].scatter(forplot_x, forplot_y, 0.005)
-axs[2].set_xlabel("Последовательный номер блока (транзакции) регистрации избирателя")
-axs[2].set_ylabel("Время выдачи бюллетеня")
-
-    
-# Show window with plot    
+# Issue times histogram of every block, blocks x bins
+def BlockBins(voted_block, voted_time, total_blocks):
+    bins = timebins.EpochMsToBin(voted_time, BIN_TIME)
+    mask = (bins >= 0) & (bins < RESULT_BINS)
+    counts = np.bincount(voted_block[mask] * RESULT_BINS + bins[mask], minlength=total_blocks * RESULT_BINS)
+    return counts.reshape(total_blocks, RESULT_BINS)
+
+# Issued ballots are added to a fixed-size density image (time rows x block columns) by chunks,
+# so memory does not depend on the number of points. Points outside of the image are dropped.
+def DensityAdd(density, block, ts, blocks_in_column, weight = 1):
+    rows, columns = density.shape
+    for i in range(0, len(block), DENSITY_CHUNK):
+        column = np.asarray(block[i:i + DENSITY_CHUNK], dtype=np.int64) // blocks_in_column
+        second = timebins.EpochMsToBin(ts[i:i + DENSITY_CHUNK], 1)
+        inside = (column >= 0) & (column < columns) & (second >= 0) & (second < PERIOD)
+        np.add.at(density.reshape(-1), second[inside] * rows // PERIOD * columns + column[inside], weight)
+
+def PrintPrerevote(prerevote_issued, prerevote_voted):
+    print("Время до возможности переголосования:", timebins.EpochToMskTime(PREREVOTE_TIME).strftime('%d.%m %H:%M'),
+          "Выдано бюллетеней:", sampling.Estimate(prerevote_issued, args.sample), "Голосов:", sampling.Estimate(prerevote_voted, args.sample))
+
+# Build several plots, block_turnout is in percent (turnout_groups.BlockPercent)
+def DrawPlots(block_turnout, block_bins, votes_time, density, blocks_in_column):
+    low_turnout_bins, high_turnout_bins, norm_turnout_bins = [timebins.Normalize(b) for b in turnout_groups.Histograms(block_bins, block_turnout)]
+    votes_count = votes_time
+    votes_time = timebins.Normalize(votes_time)
+    axs = [plt.subplot2grid((2, 2), (1, 0), colspan=2),plt.subplot2grid((2, 2),(0, 0)), plt.subplot2grid((2, 2),(0, 1))]
+
+    # Create issue ballots & vote times plot
+    markers = itertools.cycle(['o', 's', 'v', '^', 'p', '*'])
+    for curve in (low_turnout_bins, high_turnout_bins, norm_turnout_bins, votes_time):
+        axs[0].plot(curve, marker=next(markers))
+    if args.sample:
+        # Sampling error of the share of every bin in its curve
+        for curve, line in zip(turnout_groups.Histograms(block_bins, block_turnout) + (votes_count,), axs[0].get_lines()):
+            low, high = confidence.ShareBands([curve], np.full(len(curve), curve.sum()))
+            axs[0].fill_between(range(len(curve)), low[0], high[0], color=line.get_color(), alpha=0.2, linewidth=0)
+    ticks = timebins.GenerateTicks(BIN_TIME, GRAPH_TICK_TIME)
+    axs[0].set_xticks(ticks[0])
+    axs[0].set_xticklabels(ticks[1], rotation=90)
+    axs[0].grid()
+    axs[0].legend(["Динамика выдачи бюллетеней избирателям из блоков с явкой < "+str(LOW_TURNOUT_VAL)+"% (в % от полного числа таковых)", \
+        "Динамика выдачи бюллетеней избирателям из блоков с явкой > "+str(HIGH_TURNOUT_VAL)+"% (в % от полного числа таковых)", \
+        "Динамика выдачи бюллетеней избирателям из блоков с явкой "+str(LOW_TURNOUT_VAL)+"-"+str(HIGH_TURNOUT_VAL)+"% (в % от полного числа таковых)", \
+        "Динамика голосования  (в % от полного числа голосов)"])
+
+    # Create
+    axs[1].plot(block_turnout)
+    axs[1].grid()
+    axs[1].legend(["Процент проголосовавших в блоке"])
+    axs[1].set_xlabel("Последовательный номер блока (транзакции) регистрации избирателя")
+
+    # Create issue ballot time density plot, there is no image before the first block
+    if density.size:
+        period = dates.date2num(timebins.EpochMsToMskDatetime(np.array([timebins.EPOCH_MSK_START, timebins.EPOCH_MSK_END]) * 1000))
+        norm = colors.LogNorm(vmin=1, vmax=density.max(initial=1)) if args.density_scale == "log" else None
+        image = axs[2].imshow(density, origin="lower", aspect="auto", interpolation="nearest", norm=norm,
+                              extent=[0, density.shape[1] * blocks_in_column, period[0], period[1]])
+        axs[2].yaxis_date()
+        axs[2].yaxis.set_major_formatter(dates.DateFormatter("%d.%m %H:%M"))
+        plt.colorbar(image, ax=axs[2], label="Выдано бюллетеней")
+    axs[2].set_xlabel("Последовательный номер блока (транзакции) регистрации избирателя")
+    axs[2].set_ylabel("Время выдачи бюллетеня")
+
+# Follow mode keeps per-block state and updates it only with transactions newer than high-water marks
+def Follow(interval):
+    voter_block = {}
+    voter_time = {}
+    block_turnout = np.zeros(0, dtype=np.int64)
+    block_voters = np.zeros(0, dtype=np.int64)
+    block_bins = np.zeros((0, RESULT_BINS), dtype=np.int64)
+    votes_time = np.zeros(RESULT_BINS, dtype=np.int64)
+    density = np.zeros((DENSITY_ROWS, 0), dtype=np.int64)
+    prerevote_issued = 0
+    prerevote_voted = 0
+    watermarks = {m: dbaccess.NewWatermark() for m in (1, 4, 6)}
+
+    def CountIssue(v, ts, delta):
+        b = voter_block[v]
+        block_turnout[b] += delta
+        t = int(timebins.EpochMsToBin(ts, BIN_TIME))
+        if 0 <= t < RESULT_BINS:
+            block_bins[b, t] += delta
+        DensityAdd(density, [b], [ts], FOLLOW_BLOCKS_IN_COLUMN, delta)
+
+    while True:
+        with profiling.Stage("poll") as stage:
+            new_rows = 0
+            for rows in dbaccess.PollNewRows(conn, 1, "t.payload->'voters'", watermarks[1]):
+                first_block = len(block_turnout)
+                block_turnout = np.append(block_turnout, np.zeros(len(rows), dtype=np.int64))
+                block_voters = np.append(block_voters, [len(r[2]) for r in rows])
+                block_bins = np.vstack([block_bins, np.zeros((len(rows), RESULT_BINS), dtype=np.int64)])
+                new_columns = -(-len(block_turnout) // FOLLOW_BLOCKS_IN_COLUMN) - density.shape[1]
+                density = np.hstack([density, np.zeros((DENSITY_ROWS, new_columns), dtype=np.int64)])
+                for i,r in enumerate(rows):
+                    for v in r[2]:
+                        voter_block[str(v)] = first_block + i
+                        if str(v) in voter_time:
+                            CountIssue(str(v), voter_time[str(v)], 1)
+                new_rows += len(rows)
+            for rows in dbaccess.PollNewRows(conn, 4, "t.payload->>'voter_id'", watermarks[4]):
+                for r in rows:
+                    v, ts = r[2], r[1]
+                    prerevote_issued += ts < PREREVOTE_TIME * 1000
+                    if v in voter_time and voter_time[v] >= ts:
+                        continue
+                    if v in voter_block:
+                        if v in voter_time:
+                            CountIssue(v, voter_time[v], -1)
+                        CountIssue(v, ts, 1)
+                    voter_time[v] = ts
+                new_rows += len(rows)
+            for rows in dbaccess.PollNewRows(conn, 6, "null", watermarks[6]):
+                ts = np.array([r[1] for r in rows], dtype=np.int64)
+                votes_time += timebins.BinCounts(ts, BIN_TIME)
+                prerevote_voted += int(np.count_nonzero(ts < PREREVOTE_TIME * 1000))
+                new_rows += len(rows)
+            stage["rows"] = new_rows
+        if new_rows:
+            print("Новых транзакций:", new_rows)
+            PrintPrerevote(prerevote_issued, prerevote_voted)
+            with profiling.Stage("draw"):
+                plt.clf()
+                DrawPlots(turnout_groups.BlockPercent(block_turnout, block_voters), block_bins, votes_time, density, FOLLOW_BLOCKS_IN_COLUMN)
+        plt.pause(interval)
+
+if args.follow:
+    Follow(args.follow)
+
+# Every registered voter gets registration block index and time of the ballot issued to the voter, -1 if none
+with profiling.Stage("load") as stage:
+    if args.cache:
+        voter_block = analysis_cache.LoadTable(args.cache, "registrations")["block"]
+        issues = analysis_cache.LoadTable(args.cache, "issues")
+        vote_ts = analysis_cache.LoadTable(args.cache, "votes")["ts"]
+        total_blocks = analysis_cache.LoadMeta(args.cache)["registration_blocks"]
+        prerevote_issued = int(np.count_nonzero(issues["ts"] < PREREVOTE_TIME * 1000))
+        registered = issues["voter"] >= 0
+        voter_time = np.full(len(voter_block), -1, dtype=np.int64)
+        np.maximum.at(voter_time, issues["voter"][registered], issues["ts"][registered])
+    elif use_analysis_db:
+        # Only issues of voters of the sampled blocks are read
+        voter_block, voter_time = dbaccess.FetchArrays(conn, f"""
+            with r as (select r.voter_idx, r.block
+                       from analysis.blocks b join analysis.registrations r on r.block = b.block
+                       where {sampling.Condition("b.hash", dbaccess.BYTEA, args.sample)})
+            select r.block, coalesce(i.ts, -1)
+            from r left join (select voter, max(ts) as ts from analysis.issues
+                              where voter in (select voter_idx from r) group by voter) i on i.voter = r.voter_idx
+            order by r.voter_idx""", [np.int32, np.int64])
+        cur.execute("select count(*) from analysis.blocks")
+        total_blocks = cur.fetchone()[0]
+        cur.execute(f"select count(*) from analysis.issues where ts < %s and {sampling.Condition('hash', dbaccess.BYTEA, args.sample)}", (PREREVOTE_TIME * 1000,))
+        prerevote_issued = cur.fetchone()[0]
+        vote_ts, = dbaccess.FetchArrays(conn, f"select ts from analysis.votes where {sampling.Condition('hash', dbaccess.BYTEA, args.sample)}", [np.int64])
+    else:
+        # Blocks are numbered over all registrations in order of time and hash (as in analysis_db.py),
+        # payloads and issues are read only for the sampled blocks
+        voter_block, voter_time = dbaccess.FetchArrays(conn, f"""
+            with b as (select row_number() over (order by datetime, hash) - 1 as idx, hash from transactions where method_id=1),
+                 r as (select b.idx as block, v.voter
+                       from b join transactions t on t.hash = b.hash, jsonb_array_elements(t.payload->'voters') v(voter)
+                       where {sampling.Condition("b.hash", dbaccess.HEX, args.sample)})
+            select r.block, coalesce(i.ts, -1)
+            from r left join (select payload->'voter_id' as voter, max({timebins.SqlEpochMs()}) as ts
+                              from transactions where method_id=4 and payload->'voter_id' in (select voter from r)
+                              group by 1) i on i.voter = r.voter""", [np.int32, np.int64])
+        cur.execute("select count(*) from transactions where method_id=1")
+        total_blocks = cur.fetchone()[0]
+        cur.execute(f"select count(*) from transactions where method_id=4 and datetime < to_timestamp(%s) and {sampling.Condition('hash', dbaccess.HEX, args.sample)}",
+                    (PREREVOTE_TIME,))
+        prerevote_issued = cur.fetchone()[0]
+        vote_ts, = dbaccess.FetchArrays(conn, f"select {timebins.SqlEpochMs()} from transactions where method_id=6 and {sampling.Condition('hash', dbaccess.HEX, args.sample)}",
+                                        [np.int64])
+    stage["rows"] = len(voter_block) + len(vote_ts)
+prerevote_voted = int(np.count_nonzero(vote_ts < PREREVOTE_TIME * 1000))
+
+# Per block turnout and issue times histograms
+voted = voter_time >= 0
+voted_block = voter_block[voted]
+voted_time = voter_time[voted]
+with profiling.Stage("histograms") as stage:
+    # Blocks out of the sample have no voters, so their turnout is unknown and they do not get into any turnout group
+    block_voters = np.bincount(voter_block, minlength=total_blocks)
+    block_turnout = turnout_groups.BlockPercent(np.bincount(voted_block, minlength=total_blocks), block_voters)
+    if args.sample:
+        print("Блоков регистрации в выборке:", int(np.count_nonzero(block_voters)), "из", total_blocks)
+    block_bins = BlockBins(voted_block, voted_time, total_blocks)
+    votes_time = timebins.BinCounts(vote_ts, BIN_TIME)
+    blocks_in_column = max(1, -(-total_blocks // DENSITY_COLUMNS))
+    density = np.zeros((DENSITY_ROWS, -(-total_blocks // blocks_in_column)), dtype=np.int64)
+    DensityAdd(density, voted_block, voted_time, blocks_in_column)
+    stage["rows"] = len(voted_block) + len(vote_ts)
+PrintPrerevote(prerevote_issued, prerevote_voted)
+with profiling.Stage("draw"):
+    DrawPlots(block_turnout, block_bins, votes_time, density, blocks_in_column)
+
+# Show window with plot
 plt.show()
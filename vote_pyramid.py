@@ -0,0 +1,68 @@
+# Multi-resolution pyramid of per-candidate vote counts.
+#
+# The base level counts votes of every candidate per second of the voting
+# period, upper levels count them per 10 s, 1 min, 10 min and 1 hour. Every
+# level is sparse and stored as CSR: for candidate i its nonzero bins are
+# bins[offsets[i]:offsets[i+1]] with vote counts in counts[...], so memory is
+# proportional to the number of nonzero (candidate, bin) pairs. Histogram of
+# any candidates for any bin size is read from the coarsest level whose bin
+# divides it. Pyramid is saved next to the local cache, one .npy per array:
+#   pyramid.candidates.npy, pyramid.<level>.offsets.npy, .bins.npy, .counts.npy
+
+import os
+import numpy as np
+import analysis_cache
+import timebins
+
+LEVELS = [1, 10, 60, 600, 3600]
+PERIOD = timebins.EPOCH_MSK_END - timebins.EPOCH_MSK_START
+
+def ArrayPath(cache_dir, name):
+    return os.path.join(cache_dir, f"pyramid.{name}.npy")
+
+def Exists(cache_dir):
+    return os.path.exists(ArrayPath(cache_dir, "candidates"))
+
+# Builds all levels from decrypted votes (choice, epoch ms), votes outside of voting period are dropped
+def Build(choice, ts):
+    choice = np.asarray(choice)
+    seconds = np.asarray(ts, dtype=np.int64) // 1000 - timebins.EPOCH_MSK_START
+    keep = (choice != analysis_cache.NO_CHOICE) & (seconds >= 0) & (seconds < PERIOD)
+    candidates, candidate_idx = np.unique(choice[keep], return_inverse=True)
+    seconds = seconds[keep]
+    pyramid = {"candidates": candidates}
+    for level in LEVELS:
+        level_bins = PERIOD // level + 1
+        keys, counts = np.unique(candidate_idx * level_bins + seconds // level, return_counts=True)
+        owners = keys // level_bins
+        pyramid[f"{level}.offsets"] = np.searchsorted(owners, np.arange(len(candidates) + 1)).astype(np.int64)
+        pyramid[f"{level}.bins"] = (keys % level_bins).astype(np.int32)
+        pyramid[f"{level}.counts"] = counts.astype(np.int32)
+    return pyramid
+
+def Save(cache_dir, pyramid):
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, array in pyramid.items():
+        np.save(ArrayPath(cache_dir, name), array)
+
+def Load(cache_dir):
+    names = ["candidates"] + [f"{level}.{a}" for level in LEVELS for a in ("offsets", "bins", "counts")]
+    return {name: np.load(ArrayPath(cache_dir, name), mmap_mode="r") for name in names}
+
+# Vote counts of candidates, candidates x bins of bin_time seconds (like timebins.SeriesBinCounts).
+# Range start/end in seconds from the start of voting selects a part of the period, bins are counted from start.
+def Counts(pyramid, candidate_list, bin_time, start = 0, end = None):
+    end = PERIOD if end is None else min(end, PERIOD)
+    result_bins = timebins.ResultBins(bin_time) if (start, end) == (0, PERIOD) else (end - start) // bin_time
+    level = max(l for l in LEVELS if bin_time % l == 0 and start % l == 0)
+    offsets, bins, counts = (pyramid[f"{level}.{a}"] for a in ("offsets", "bins", "counts"))
+    result = np.zeros((len(candidate_list), result_bins), dtype=np.int64)
+    for i, idx in enumerate(timebins.SeriesIndex(candidate_list, pyramid["candidates"])):
+        if idx < 0:
+            continue
+        # Nonzero bins of a candidate are sorted, so the range is a slice
+        first, last = offsets[idx], offsets[idx + 1]
+        lo, hi = first + np.searchsorted(bins[first:last], [start // level, (start + result_bins * bin_time) // level])
+        b = (bins[lo:hi].astype(np.int64) * level - start) // bin_time
+        result[i] = np.bincount(b, weights=counts[lo:hi], minlength=result_bins)[:result_bins]
+    return result